@@ -14,6 +14,11 @@ config：
   'partition_col': ['statedate']  注意把日期字段放在第一个位置，如果有多个分区字段的话
   'frequence': 1,2,3,4            表示每1(2,3,4)天备份，1表示每天备份，2表示每2天备份1次，3表示每3天备份1次
   'job_hour': [5, 12, 17]         表示5点，12点，17点的时候备份，当一天多次备份时候有用，多天一次相当于指定什么时候启动任务备份
+  'source_db': ''                 可选，MySQL快速连接的query，不写就用 mysql_query
+  'read_workers': 2               可选，这个表同时读取MySQL分区的线程数，不写就用 read_workers
+  'watermark_col': 'update_time'  可选，增量备份的高水位字段（更新时间戳或者自增id），不写就按分区全量备份
+  'key_col': ['id']               可选，增量备份时的主键，按主键替换hive分区的旧数据；不写表示只追加，watermark_col 必须是自增id
+  'lookback_seconds': 300         可选，有主键的增量备份从高水位往前回看的秒数，防止漏掉晚提交的数据
 }
 """
 
@@ -34,5 +39,18 @@ backup_tb = [
 
 # 存放上次备选信息的json文件
 last_backup_info_file = os.path.join(__path__[0], 'table_last_backup_time.json')
+# 备份状态库，记录表的备份时间和分区检查点；旧的json文件只在第一次使用状态库时导入
+state_db_file = os.path.join(__path__[0], 'backup_state.db')
 # 临时数据文件路径
 local_path = root_ex_data
+
+# 数据库快速连接
+mysql_query = ''
+hive_query = ''
+
+# 并发设置
+table_workers = 2       # 同时备份多少个表
+read_workers = 2        # 每个表同时从MySQL读取多少个分区
+prefetch = 2            # 每个表已读取但还没导入hive的分区数上限，控制内存
+# 每个MySQL源（source_db）同时最多占用多少个连接，没有配置的源使用 default
+source_max_conn = {'default': 4}
@@ -1,12 +1,27 @@
 # -*- coding: utf-8 -*-
 """
 将mysql的数据保存到hive分区表
+
+多个表并发备份，每个表内部读MySQL和导hive流水线执行：
+1、table_workers 控制同时备份多少个表
+2、read_workers 控制每个表同时读取多少个MySQL分区，读到的分区交给导hive的线程，读和导重叠执行
+3、source_max_conn 控制同一个MySQL源的并发连接数，多个表共享这个限制
+4、单个表备份失败不影响其他表，最后汇总打印每个表的备份情况
+
+备份状态保存在sqlite状态库（mysql2hive.backup_state）中，记录到分区级别，重跑时跳过已经完成的分区，
+多个备份进程也可以共用一个状态库，一个表的分区被多个进程分着备份时，
+自己的分区完成但其他进程还没完成的表，状态是 partial，由最后完成的进程更新备份时间。
+
+如果表配置了 watermark_col，则使用增量备份，只取出高水位之后变化的数据合并到hive分区，参见 mysql2hive.back_tb_data_incremental
 """
 
 import datetime
+import threading
+import time
+import traceback
 import pandas as pd
-import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor
 from .common.database import pyhive
 from .common.database import pymysql
 from .common.database import pyfile
@@ -18,34 +33,35 @@ pyos = pyfile.pyos()
 pyjson = pyfile.pyjson()
 
 
-def main():
-    """其他程序或者模块需要备份数据，仿照这个demo实现即可"""
-    #
-    # 连接MySQL，hive数据库
-    statedate = str(datetime.datetime.now())[:10]
-    log = _log.logger(logname='mysql2hive_databack')
-    #
-    ai_mysql = pymysql.mysql(query='')
-    ai_hive = pyhive.pyhive(query='')
-    log.info('连接MySQL，hive数据库')
-    #
-    # 从config中读取那些表需要备份
-    # 为了方便写代码这里将config配置成一个class，实际使用时应该写成配置文件
-    back_info_file = config.last_backup_info_file
-    local_path = config.local_path
-    #
-    for table in config.backup_tb:
-        # 读取需要备份的表信息
-        tb_name1 = table['source_tb']
-        tb_name2 = table['target_tb']
-        partition_col = table['partition_col']
-        frequency = table['frequency']
-        job_hour = table['job_hour']
+def source_limits(backup_tb):
+    """每个MySQL源创建一个信号量，限制这个源的并发连接数"""
+    limits = {}
+    for table in backup_tb:
+        source = table.get('source_db', config.mysql_query)
+        if source not in limits:
+            max_conn = config.source_max_conn.get(source, config.source_max_conn['default'])
+            limits[source] = threading.BoundedSemaphore(max_conn)
+    return limits
+
+
+def backup_one_table(table, statedate, limits, state, log):
+    """备份一个表，返回这个表的备份统计信息，出错不抛异常，而是记录在统计信息里"""
+    tb_name1 = table['source_tb']
+    tb_name2 = table['target_tb']
+    partition_col = table['partition_col']
+    frequency = table['frequency']
+    job_hour = table['job_hour']
+    source = table.get('source_db', config.mysql_query)
+    summary = {'source_tb': tb_name1, 'target_tb': tb_name2, 'status': 'skip',
+               'partitions': 0, 'rows': 0, 'seconds': 0.0, 'rows_per_sec': 0.0, 'error': ''}
+    t1 = time.time()
+    ai_hive = None
+    try:
         # 首先判断是否会造成重复备份数据
-        repeat, last_time = m2h.do_not_repeat_backup(back_info_file = back_info_file, tb_name=tb_name1, frequency=frequency, job_hour=job_hour, mode='read')
+        repeat, last_time = state.do_not_repeat_backup(tb_name1, frequency=frequency, job_hour=job_hour)
         # 已经备份过的数据就不进行备份了
         if repeat:
-            continue
+            return summary
         #
         # 备份其他未备份的数据
         # 获取上次备份时间
@@ -53,11 +69,69 @@ def main():
             last_time = str(pd.to_datetime(statedate) - datetime.timedelta(days=frequency))[:10]
         else:
             last_time = str(pd.to_datetime(last_time) - datetime.timedelta(days=0))[:10]
+        # MySQL是连接池，可以多线程共用；impyla连接不是线程安全的，每个表单独连接hive
+        ai_mysql = pymysql.mysql(query=source)
+        ai_hive = pyhive.pyhive(query=config.hive_query)
         # 备份
-        m2h.back_tb_data(ai_mysql, ai_hive, tb_name1, tb_name2, last_time, partition_col, local_path, log)
-        # 更新备份表信息
-        m2h.do_not_repeat_backup(back_info_file = back_info_file, tb_name = tb_name1, mode='update')
+        watermark = None
+        if table.get('watermark_col'):
+            # 增量备份：只备份高水位之后变化的数据，高水位在 finish_table 中和备份时间一起更新
+            with limits[source]:
+                rows, partitions, watermark = m2h.back_tb_data_incremental(
+                    ai_mysql, ai_hive, tb_name1, tb_name2, table['watermark_col'], state.get_watermark(tb_name1),
+                    partition_col, config.local_path, log, key_col=table.get('key_col'),
+                    lookback_seconds=table.get('lookback_seconds', 300), state=state)
+        else:
+            rows, partitions = m2h.back_tb_data_pipeline(ai_mysql, ai_hive, tb_name1, tb_name2, last_time,
+                                                         partition_col, config.local_path, log,
+                                                         read_workers=table.get('read_workers', config.read_workers),
+                                                         prefetch=config.prefetch,
+                                                         source_limit=limits[source],
+                                                         state=state)
+        # 更新备份表信息，清空分区检查点；其他进程还有分区没备份完时，由最后完成的进程更新
+        if state.finish_table(tb_name1, watermark=watermark):
+            summary.update({'status': 'ok', 'partitions': partitions, 'rows': rows})
+        else:
+            log.info('表 %s 还有分区在其他进程备份或者备份失败，暂不更新备份时间' % tb_name1)
+            summary.update({'status': 'partial', 'partitions': partitions, 'rows': rows})
+    except:
+        error = traceback.format_exc()
+        log.info('表 %s 备份失败，继续备份其他表：\n%s' % (tb_name1, error))
+        summary.update({'status': 'fail', 'error': error.strip().split('\n')[-1][:100]})
+    finally:
+        if ai_hive is not None and ai_hive.conn:
+            ai_hive.close()
+    summary['seconds'] = round(time.time() - t1, 2)
+    if summary['seconds'] > 0:
+        summary['rows_per_sec'] = round(summary['rows'] / summary['seconds'], 2)
+    return summary
+
+
+def main():
+    """其他程序或者模块需要备份数据，仿照这个demo实现即可"""
+    #
+    statedate = str(datetime.datetime.now())[:10]
+    log = _log.logger(logname='mysql2hive_databack')
+    #
+    # 从config中读取那些表需要备份，每个MySQL源的连接数限制
+    limits = source_limits(config.backup_tb)
+    # 备份状态库，记录表的备份时间和分区检查点，第一次使用时从旧的json文件导入备份时间
+    state = m2h.backup_state(config.state_db_file, json_file=config.last_backup_info_file)
+    log.info('并发备份 %d 个表，同时备份 %d 个表，每个表 %d 个线程读取MySQL' %
+             (len(config.backup_tb), config.table_workers, config.read_workers))
+    #
+    # 多个表并发备份，单个表失败不影响其他表
+    with ThreadPoolExecutor(max_workers=config.table_workers) as pool:
+        futures = [pool.submit(backup_one_table, table, statedate, limits, state, log) for table in config.backup_tb]
+        all_summary = [future.result() for future in futures]
     #
+    # 汇总每个表的备份情况
+    all_summary = pd.DataFrame(all_summary, columns=['source_tb', 'target_tb', 'status', 'partitions', 'rows',
+                                                     'seconds', 'rows_per_sec', 'error'])
+    log.info('备份汇总：\n' + log.create_pretty_table(all_summary))
+    failed = all_summary.loc[all_summary['status'] == 'fail', 'source_tb'].tolist()
+    if failed:
+        raise Exception('以下表备份失败，请检查：%s' % ', '.join(failed))
     log.info('完成所有表的数据备份')
 
 
@@ -10,8 +10,16 @@
 1、这里需要 MySQL 事先创建好表，而且 MySQL 和 hive 表的字段名称和数量保持一致.
 2、默认情况下会先清空MySQL的表，可以通过参数控制
 
+千万级的报表如果一次性读到内存，进程会超出内存限制，因此这里是流式导入的：
+hive 每次取出 chunk_size 条数据，放入有界队列，多个线程从队列取出数据写入MySQL，内存只和 chunk_size * queue_size 有关。
+导入方式有两种：
+1、truncate：先清空MySQL表再导入，导入过程中读表的人会看到不完整的数据
+2、swap：先导入到一个临时表，全部成功后用 rename table 原子地替换原表，读表的人永远不会看到导入一半的表
+
 """
+import threading
 import traceback
+from queue import Queue, Full
 from . import pymysql
 from . import pyhive
 
@@ -43,7 +51,72 @@ class hive2mysql():
             print(self._hive_conn.read_table(sql='select 1 as hive'))
             print('连接hive成功')
 
-    def hive_data_to_mysql(self, mysql_tb_name, hive_tb_name=None, hive_sql=None, truncate_mysql_tb=True):
+    def _check_mysql_conn(self):
+        """判断连接是否正常"""
+        try:
+            print(self._mysql_conn.read_table(sql='select 1 as mysql'))
+        except:
+            self._mysql_conn = pymysql.mysql(query=self._mysql_query)
+
+    def _execute_mysql(self, sql):
+        """执行MySQL的DDL，出错就报错"""
+        print(sql)
+        ok, error = self._mysql_conn.execute(sql)
+        if not ok:
+            raise Exception(error)
+
+    def _write_chunks(self, chunks, mysql_tb_name, writers=2, queue_size=4):
+        """
+        将dataframe块流式写入MySQL：当前线程从chunks取数据放入有界队列，writers个线程从队列取出后写入MySQL.
+        队列满了读取就会等待，所以内存中最多只有 queue_size + writers 个数据块。
+        任何一个写线程出错，都会停止读取并报错。
+        :return: 写入的数据量
+        """
+        data_queue = Queue(maxsize=queue_size)
+        errors = []
+        rows = [0]
+        rows_lock = threading.Lock()
+
+        def writer():
+            while True:
+                df = data_queue.get()
+                if df is None:
+                    break
+                # 已经有线程出错了，剩下的数据只取出来不写，防止读取线程卡在put上
+                if errors:
+                    continue
+                ok, error = self._mysql_conn.df_into_db(tb_name=mysql_tb_name, df=df, types='insert')
+                if not ok:
+                    errors.append(error)
+                    continue
+                with rows_lock:
+                    rows[0] += len(df)
+
+        all_writers = [threading.Thread(target=writer) for _ in range(writers)]
+        for t in all_writers:
+            t.start()
+        try:
+            for df in chunks:
+                while not errors:
+                    try:
+                        data_queue.put(df, timeout=1)
+                        break
+                    except Full:
+                        continue
+                if errors:
+                    break
+        finally:
+            # 每个写线程一个结束标志
+            for _ in all_writers:
+                data_queue.put(None)
+            for t in all_writers:
+                t.join()
+        if errors:
+            raise Exception(errors[0])
+        return rows[0]
+
+    def hive_data_to_mysql(self, mysql_tb_name, hive_tb_name=None, hive_sql=None, truncate_mysql_tb=True,
+                           swap=False, chunk_size=200000, writers=2, queue_size=4):
         """
         读取数据，保存到mysql.
         读取hive数据的时候，可以传入表名，也可以传入具体的查询SQL
@@ -51,20 +124,42 @@ class hive2mysql():
         :param hive_tb_name:
         :param hive_sql:
         :param truncate_mysql_tb: 数据导入MySQL之前是否先清空mysql表
-        :return:
+        :param swap: 先导入到临时表 mysql_tb_name__staging，成功后原子替换原表，这时 truncate_mysql_tb 不起作用
+        :param chunk_size: 每次从hive取多少条数据
+        :param writers: 写MySQL的线程数
+        :param queue_size: 已读取但还没写入MySQL的数据块上限
+        :return: 导入的数据量
         """
-        # 读取hive数据
-        hive_tb = self._hive_conn.read_table(tb_name=hive_tb_name, sql=hive_sql)    # 这种方式比较安全
-        #
-        # 先清空mysql数据
-        mode = 'truncate' if truncate_mysql_tb else 'insert'
         # 判断连接是否正常
+        self._check_mysql_conn()
+        # 和 df_into_db 保持一致：库名大写表名小写
+        if '.' in mysql_tb_name:
+            mysql_tb_name = mysql_tb_name.split('.')[0].upper() + '.' + mysql_tb_name.split('.')[1].lower()
+        # 确定写入哪个表
+        if swap:
+            target_tb = mysql_tb_name + '__staging'
+            old_tb = mysql_tb_name + '__old'
+            self._execute_mysql('drop table if exists %s' % target_tb)
+            self._execute_mysql('create table %s like %s' % (target_tb, mysql_tb_name))
+        else:
+            target_tb = mysql_tb_name
+            # 先清空mysql数据
+            if truncate_mysql_tb:
+                self._execute_mysql('truncate table %s' % target_tb)
+        # 逐块读取hive数据，流式写入MySQL
+        chunks = self._hive_conn.read_table_chunks(tb_name=hive_tb_name, sql=hive_sql, chunk_size=chunk_size)
         try:
-            print(self._mysql_conn.read_table(sql='select 1 as mysql'))
+            rows = self._write_chunks(chunks, target_tb, writers=writers, queue_size=queue_size)
         except:
-            self._mysql_conn = pymysql.mysql(query=self._mysql_query)
-        # 数据入库
-        ok, error = self._mysql_conn.df_into_db(tb_name=mysql_tb_name, df=hive_tb, types=mode)
-        if not ok:
-            raise Exception(error)
-        print('将hive的表导入到mysql成功')
+            if swap:
+                self._execute_mysql('drop table if exists %s' % target_tb)
+            raise
+        finally:
+            chunks.close()
+        # 临时表原子替换原表
+        if swap:
+            self._execute_mysql('drop table if exists %s' % old_tb)
+            self._execute_mysql('rename table %s to %s, %s to %s' % (mysql_tb_name, old_tb, target_tb, mysql_tb_name))
+            self._execute_mysql('drop table %s' % old_tb)
+        print('将hive的表导入到mysql成功，数据量：%d' % rows)
+        return rows
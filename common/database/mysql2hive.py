@@ -34,6 +34,8 @@ config：
   'frequence': 1,2,3,4            表示每1(2,3,4)天备份，1表示每天备份，2表示每2天备份1次，3表示每3天备份1次
   'job_hour': [5, 12, 17]         表示5点，12点，17点的时候备份，当一天多次备份时候有用，多天一次相当于指定什么时候启动任务备份
   'describe': 'describe'          任务描述
+  'watermark_col': 'update_time'  可选，增量备份的高水位字段，更新时间戳或者自增id
+  'key_col': ['id']               可选，增量备份时的主键，不写表示只追加不更新的表
 }
 
 步骤：
@@ -50,11 +52,24 @@ config：
 
 3、备份是从上次备份时间点再往前一小段时间开始备份的
 
+增量备份（CDC）：
+对于每天只有少量数据变化的大表，按分区重新读取太浪费了。配置了 watermark_col 的表，记录每次备份到的高水位，
+下次只取出高水位之后的数据，按分区合并到hive：
+1、有主键（key_col）：替换分区中的旧数据，重复合并不会出错，所以从高水位再往前回看一小段时间（lookback_seconds）开始取，
+   防止取最大值之后才提交、但时间戳不大于最大值的数据被漏掉
+2、没有主键：直接追加到分区，只能用于自增id作为高水位的只插入表，取大于高水位的数据
+高水位和备份时间保存在 backup_state 状态库中，每个分区合并完成后记录检查点，重跑时跳过已经合并的分区，不会重复追加。
+
 """
 
 import pandas as pd
 import datetime
 import os
+import socket
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 # from aipurchase.common.database import pyhive
 # from aipurchase.common.database import pymysql
 # from aipurchase.common.database import pyfile
@@ -62,6 +77,7 @@ import os
 from . import pyhive
 from . import pymysql
 from . import pyfile
+from . import pysqlite
 from ..log import log as _log
 
 pyos = pyfile.pyos()
@@ -107,6 +123,24 @@ def backup_batch_in_theory(frequence, job_hour):
             return last_job, next_job
 
 
+def has_been_backed_up(tb_name, last_time, frequency, job_hour):
+    """根据上次备份时间判断当前批次是否已经备份过，True表示不需要备份"""
+    now = str(datetime.datetime.now())[:19]
+    # 如果是多天备份一次，看上次执行时间和当前时间是否超过fre天
+    # 如果超过了fre天，且达到备份时间点，则说明需要备份
+    #
+    if frequency > 1 and day_sub(now, last_time) >= frequency and int(now[11:13]) > job_hour[0]:
+        return False  # false表示需要备份
+    #
+    # 如果是1天1次或者1天多次，就比较简单了
+    last_job, next_job = backup_batch_in_theory(frequency, job_hour)
+    if frequency == 1 and last_job <= last_time <= next_job:
+        print('表：%s 上次备份的时间是%s，当前时间是：%s，不需要重复备份' % (tb_name, last_time, now))
+        return True  # 不需要备份
+    else:
+        return False  # 需要备份
+
+
 def do_not_repeat_backup(back_info_file, tb_name, frequency=None, job_hour=None, mode='read'):
     """
     对于重试等，如果某个表已经正常备份，在失败重试阶段就没必要再次备份了
@@ -125,25 +159,175 @@ def do_not_repeat_backup(back_info_file, tb_name, frequency=None, job_hour=None,
     # 判断是否需要备份，特别是失败重试的情况下需要做这样的处理
     if mode == 'read':
         last_time = last_backup.get(tb_name, '2017-01-01 01:01:01')
-        # 如果是多天备份一次，看上次执行时间和当前时间是否超过fre天
-        # 如果超过了fre天，且达到备份时间点，则说明需要备份
-        #
-        if frequency > 1 and day_sub(now, last_time) >= frequency and int(now[11:13]) > job_hour[0]:
-            return False, last_time  # false表示需要备份
-        #
-        # 如果是1天1次或者1天多次，就比较简单了
-        last_job, next_job = backup_batch_in_theory(frequency, job_hour)
-        if frequency == 1 and last_job <= last_time <= next_job:
-            print('表：%s 上次备份的时间是%s，当前时间是：%s，不需要重复备份' % (tb_name, last_time, now))
-            return True, last_time  # 不需要备份
-        else:
-            return False, last_time  # 需要备份
+        return has_been_backed_up(tb_name, last_time, frequency, job_hour), last_time
     # 如果备份完成，更新json信息
     if mode == 'update':
         last_backup[tb_name] = now
         pyjson.write(back_info_file, last_backup)
 
 
+class backup_state():
+    """
+    基于sqlite的备份状态库，替代 do_not_repeat_backup 的json文件。
+    json文件每次更新都要整个重写，而且只记录到表级别，200个分区备份到第150个失败，重跑时150个分区都要重新备份。
+    这里记录到分区级别：
+    1、table_backup：每个表的上次备份时间和增量备份的高水位
+    2、partition_checkpoint：当前这一轮备份中每个分区的状态，running/done/fail
+    重跑时跳过已经done的分区；这一轮的分区都done之后，更新表的备份时间并清空这个表的分区检查点，下一轮重新开始。
+
+    多个备份进程可以共用一个状态库，连接、WAL等设置和写事务都由 pysqlite 负责。
+    分区要先 claim_partition 抢到才能备份，抢到的分区超过 lease_seconds 没有完成，认为那个进程已经挂了，其他进程可以接手。
+    一个进程备份完自己抢到的分区时，其他进程可能还在备份别的分区，这时 finish_table 不会更新备份时间，等最后一个进程完成。
+
+    一轮备份：备份函数确定要备份哪些分区后调用 begin_round，记下这一轮的分区和开始时表的备份时间。
+    finish_table 只检查这一轮的分区，不在这一轮里的旧检查点（比如已经滑出备份窗口的失败分区）不会让表一直完成不了；
+    其他进程已经完成了这一轮（表的备份时间变了），claim_partition 不再抢占，避免重复备份。
+    """
+
+    def __init__(self, db_file, json_file=None, timeout=60, lease_seconds=3600):
+        self._db = pysqlite.pysqlite(db_file, timeout=timeout)  # timeout：等待其他进程释放写锁的秒数
+        self._lease_seconds = lease_seconds
+        self._rounds = {}  # 表名 -> (这一轮开始时表的备份时间, 这一轮的分区key)，每个表只在一个线程中备份
+        self._init_db()
+        # 从旧的json文件导入备份时间，只在状态库里没有这个表的时候导入
+        if json_file and pyos.file_exists(json_file):
+            self.import_json(json_file)
+
+    def _init_db(self):
+        """建表"""
+        self._db.execute("""create table if not exists table_backup (
+                            tb_name text primary key, last_time text, watermark text)""")
+        self._db.execute("""create table if not exists partition_checkpoint (
+                            tb_name text, partition_value text, status text, worker text,
+                            rows integer, error text, update_time text,
+                            primary key (tb_name, partition_value))""")
+
+    def import_json(self, json_file):
+        """从 do_not_repeat_backup 的json文件导入备份时间，旧版本保存在 '__watermark__' 下的高水位也一起导入"""
+        last_backup = pyjson.read(json_file)
+        all_watermark = last_backup.pop('__watermark__', {})
+        sql = "insert or ignore into table_backup (tb_name, last_time, watermark) values (?, ?, ?)"
+        with self._db.transaction() as conn:
+            conn.executemany(sql, [(tb_name, last_time, all_watermark.get(tb_name))
+                                   for tb_name, last_time in last_backup.items()])
+
+    def partition_key(self, partition_value):
+        """分区组合转成一个字符串，作为检查点的key"""
+        return '|'.join([str(v) for v in partition_value])
+
+    def get_last_time(self, tb_name, default='2017-01-01 01:01:01'):
+        """表的上次备份时间"""
+        result = self._db.query("select last_time from table_backup where tb_name = ?", (tb_name,))
+        return result[0][0] if result and result[0][0] else default
+
+    def do_not_repeat_backup(self, tb_name, frequency=None, job_hour=None):
+        """和 do_not_repeat_backup(mode='read') 一样，返回 (是否已经备份, 上次备份时间)"""
+        last_time = self.get_last_time(tb_name)
+        return has_been_backed_up(tb_name, last_time, frequency, job_hour), last_time
+
+    def get_watermark(self, tb_name):
+        """增量备份的高水位，没有则返回None"""
+        result = self._db.query("select watermark from table_backup where tb_name = ?", (tb_name,))
+        return result[0][0] if result else None
+
+    def set_watermark(self, tb_name, watermark):
+        """更新增量备份的高水位"""
+        with self._db.transaction() as conn:
+            conn.execute("insert or ignore into table_backup (tb_name) values (?)", (tb_name,))
+            conn.execute("update table_backup set watermark = ? where tb_name = ?", (str(watermark), tb_name))
+
+    def _round_start(self, conn, tb_name):
+        """表当前的备份时间，作为一轮备份的标识，还没有备份过是None"""
+        result = conn.execute("select last_time from table_backup where tb_name = ?", (tb_name,)).fetchone()
+        return result[0] if result else None
+
+    def begin_round(self, tb_name, partition_values):
+        """开始一轮备份，partition_values 是这一轮要备份的所有分区（包括上次已经完成的）"""
+        keys = [self.partition_key(value) for value in partition_values]
+        self._rounds[tb_name] = (self._round_start(self._db.connect(), tb_name), keys)
+
+    def checkpoints(self, tb_name):
+        """这个表所有的分区检查点，{分区key: 状态}"""
+        result = self._db.query("select partition_value, status from partition_checkpoint where tb_name = ?",
+                                (tb_name,))
+        return dict(result)
+
+    def done_partitions(self, tb_name):
+        """当前这一轮已经完成的分区"""
+        result = self._db.query("select partition_value from partition_checkpoint where tb_name = ? and status = 'done'",
+                                (tb_name,))
+        return set([row[0] for row in result])
+
+    def claim_partition(self, tb_name, partition_value, worker=None):
+        """
+        抢占一个分区，抢到了返回True。
+        已经完成的分区、其他进程正在备份并且没有超时的分区，都抢不到；
+        调用过 begin_round 的话，其他进程已经完成了这一轮时也抢不到。
+        """
+        key = self.partition_key(partition_value)
+        worker = worker if worker else '%s:%d:%d' % (socket.gethostname(), os.getpid(), threading.get_ident())
+        now = str(datetime.datetime.now())[:19]
+        expire = str(datetime.datetime.now() - datetime.timedelta(seconds=self._lease_seconds))[:19]
+        sql1 = """insert or ignore into partition_checkpoint (tb_name, partition_value, status, update_time)
+                  values (?, ?, 'fail', ?)"""
+        sql2 = """update partition_checkpoint set status = 'running', worker = ?, update_time = ?
+                  where tb_name = ? and partition_value = ?
+                  and (status = 'fail' or (status = 'running' and update_time < ?))"""
+        with self._db.transaction() as conn:
+            if tb_name in self._rounds and self._round_start(conn, tb_name) != self._rounds[tb_name][0]:
+                return False
+            conn.execute(sql1, (tb_name, key, now))
+            cnt = conn.execute(sql2, (worker, now, tb_name, key, expire)).rowcount
+        return cnt == 1
+
+    def finish_partition(self, tb_name, partition_value, rows=0):
+        """分区备份完成"""
+        sql = """update partition_checkpoint set status = 'done', rows = ?, error = null, update_time = ?
+                 where tb_name = ? and partition_value = ?"""
+        with self._db.transaction() as conn:
+            conn.execute(sql, (rows, str(datetime.datetime.now())[:19], tb_name, self.partition_key(partition_value)))
+
+    def fail_partition(self, tb_name, partition_value, error=''):
+        """分区备份失败，其他进程或者重跑时可以重新抢占"""
+        sql = """update partition_checkpoint set status = 'fail', error = ?, update_time = ?
+                 where tb_name = ? and partition_value = ?"""
+        with self._db.transaction() as conn:
+            conn.execute(sql, (str(error)[-1000:], str(datetime.datetime.now())[:19], tb_name,
+                               self.partition_key(partition_value)))
+
+    def finish_table(self, tb_name, watermark=None):
+        """
+        整个表备份完成：更新备份时间（增量备份同时更新高水位），清空这个表的分区检查点，返回True。
+        调用过 begin_round 的话只检查这一轮的分区，否则检查这个表所有的检查点；
+        还有分区没有完成（其他进程正在备份，或者失败了）时什么都不做，返回False。
+        其他进程已经完成了这一轮时，直接返回True。
+        清空检查点时，保留其他进程正在备份、还没超时的分区（它们属于别的备份窗口）。
+        检查和更新在同一个写事务中，不会删掉其他进程刚抢到的分区
+        """
+        now = str(datetime.datetime.now())[:19]
+        expire = str(datetime.datetime.now() - datetime.timedelta(seconds=self._lease_seconds))[:19]
+        round_start, keys = self._rounds.pop(tb_name, (None, None))
+        with self._db.transaction() as conn:
+            if keys is None:
+                unfinished = conn.execute("select count(*) from partition_checkpoint where tb_name = ? and status != 'done'",
+                                          (tb_name,)).fetchone()[0]
+            elif self._round_start(conn, tb_name) != round_start:
+                return True
+            else:
+                status = dict(conn.execute("select partition_value, status from partition_checkpoint where tb_name = ?",
+                                           (tb_name,)).fetchall())
+                unfinished = len([key for key in keys if status.get(key) != 'done'])
+            if unfinished:
+                return False
+            conn.execute("insert or ignore into table_backup (tb_name) values (?)", (tb_name,))
+            conn.execute("update table_backup set last_time = ? where tb_name = ?", (now, tb_name))
+            if watermark is not None:
+                conn.execute("update table_backup set watermark = ? where tb_name = ?", (str(watermark), tb_name))
+            conn.execute("""delete from partition_checkpoint where tb_name = ?
+                            and not (status = 'running' and update_time >= ?)""", (tb_name, expire))
+        return True
+
+
 def mysqltype_to_hivetype(mysqltype):
     """MySQL数据类型映射为hive的数据类型，当前只支持3中"""
     if 'bigint' in mysqltype:
@@ -291,62 +475,297 @@ def add_cols_that_not_exists_mysql(df, exist_hive_col):
     return df
 
 
-def back_tb_data(ai_mysql, ai_hive, tb_name1, tb_name2, last_time, partition_col, local_path, log):
-    """根据数据表中的日期，以及上次备份时间，取出需要备份的数据"""
-    # 第一步：看看有哪些分区数据还没有备份
-    # 第二步：读取一个分区
-    # 第三步：对比MySQL表和hive表的字段差异，增补字段
-    # 第四步：数据导入hive
+def get_backup_partitions(ai_mysql, tb_name1, last_time, partition_col):
+    """看看有哪些分区数据还没有备份，返回分区组合的dataframe（全部转成字符串）"""
     last_time = str(pd.to_datetime(last_time))[:10]
     partition_field = ', '.join(partition_col)
     partitions_sql = "select distinct %s from %s where %s >= '%s' " % \
                      (partition_field, tb_name1, partition_col[0], last_time)
-    all_partitions = ai_mysql.read_table(sql=partitions_sql).applymap(str)
-    log.info('还需要备份的分区是：\n' + log.create_pretty_table(all_partitions))
-    # 字段检查
+    return ai_mysql.read_table(sql=partitions_sql).applymap(str)
+
+
+def partition_select_sql(tb_name1, partition_col, partition_row):
+    """组装读取一个分区组合数据的SQL，返回 (sql, partition_value)"""
+    partition_value = tuple(partition_row)
+    condition = ' and '.join(["%s = '%s'" % (col, value) for col, value in zip(partition_col, partition_value)])
+    sql = "select * from %s where %s " % (tb_name1, condition)
+    return sql, partition_value
+
+
+def prepare_hive_columns(ai_mysql, ai_hive, tb_name1, tb_name2, partition_col, all_partitions):
+    """字段检查，并在hive表里面新增MySQL有而hive没有的字段，返回hive有MySQL无的字段"""
     exist_mysql_col, exist_hive_col = check_columns_between_mysql_and_hive(
         ai_mysql, ai_hive, tb_name1, tb_name2, partition_col)
-    # 在hive表里面新增字段
     if len(exist_mysql_col):
         add_cols_that_not_exists_hive(ai_hive, tb_name2, exist_mysql_col, partition_col, all_partitions)
+    return exist_hive_col
+
+
+def load_partition_into_hive(ai_hive, df, tb_name1, tb_name2, partition_col, partition_value, exist_hive_col,
+                             local_path, log, overwrite=True):
+    """将一个分区的MySQL数据导入hive分区，返回导入的数据量。overwrite=False 表示追加到分区"""
+    if len(df) == 0:
+        log.info('%s 的 partition=%s 没有数据，不需要转成到hive' % (tb_name1, str(partition_value)))
+        return 0
+    # 用一个比较特别的数据填充hive有MySQL无的字段
+    if len(exist_hive_col):
+        df = add_cols_that_not_exists_mysql(df, exist_hive_col)
+    # 保存到hive
+    ok, error = ai_hive.load_df_into_partition_table2(tb_name=tb_name2,
+                                                      df=df,
+                                                      partition_col=partition_col,
+                                                      partition_value=partition_value,
+                                                      local_path=local_path,
+                                                      sep='\001',
+                                                      overwrite=overwrite)
+    if not ok:
+        raise Exception(error)
+    log.info('导入MySQL %s的数据到hive分区：partition=%s' % (tb_name1, str(partition_value)))
+    return len(df)
+
+
+def back_tb_data(ai_mysql, ai_hive, tb_name1, tb_name2, last_time, partition_col, local_path, log):
+    """根据数据表中的日期，以及上次备份时间，取出需要备份的数据，返回备份的数据量"""
+    # 第一步：看看有哪些分区数据还没有备份
+    # 第二步：读取一个分区
+    # 第三步：对比MySQL表和hive表的字段差异，增补字段
+    # 第四步：数据导入hive
+    all_partitions = get_backup_partitions(ai_mysql, tb_name1, last_time, partition_col)
+    log.info('还需要备份的分区是：\n' + log.create_pretty_table(all_partitions))
+    # 字段检查，在hive表里面新增字段
+    exist_hive_col = prepare_hive_columns(ai_mysql, ai_hive, tb_name1, tb_name2, partition_col, all_partitions)
     # 每个分区组合读取一次
+    rows = 0
     for i in range(len(all_partitions)):
-        if len(partition_col) == 1:
-            sql = "select * from %s where %s = '%s' "
-            partition_value = (all_partitions.iloc[i, 0],)
-            args = (tb_name1, partition_col[0], all_partitions.iloc[i, 0])
-        else:
-            sql = "select * from %s where %s = '%s' "
-            partition_value = [all_partitions.iloc[i, 0]]
-            args = [tb_name1, partition_col[0], all_partitions.iloc[i, 0]]
-            for j in range(1, len(partition_col)):
-                sql = sql + "and %s = '%s' "
-                partition_value.append(all_partitions.iloc[i, j])
-                args.extend([partition_col[j], all_partitions.iloc[i, j]])
-            partition_value = tuple(partition_value)
-            args = tuple(args)
+        mysql_sql, partition_value = partition_select_sql(tb_name1, partition_col, all_partitions.iloc[i].tolist())
         # 读取MySQL数据
-        mysql_sql = sql % args
         df = ai_mysql.read_table(sql=mysql_sql)
         log.info('SQL：%s'%mysql_sql)
         log.info('读取 %s 表的 partition=%s 的数据，数据量：%d' % (tb_name1, str(partition_value), len(df)))
-        if len(df)==0:
-            log.info('没有数据，不需要转成到hive')
-            continue
-        # 用一个比较特别的数据填充hive有MySQL无的字段
-        if len(exist_hive_col):
-            df = add_cols_that_not_exists_mysql(df, exist_hive_col)
-        # 保存到hive
-        ok, error = ai_hive.load_df_into_partition_table2(tb_name=tb_name2,
-                                                          df=df,
-                                                          partition_col=partition_col,
-                                                          partition_value=partition_value,
-                                                          local_path=local_path,
-                                                          sep='\001')
-        if not ok:
-            raise Exception(error)
-        log.info('导入MySQL %s的数据到hive分区：partition=%s' % (tb_name1, str(partition_value)))
+        rows += load_partition_into_hive(ai_hive, df, tb_name1, tb_name2, partition_col, partition_value,
+                                         exist_hive_col, local_path, log)
+    log.info('完成 %s 的所有分区备份' % tb_name1)
+    return rows
+
+
+def back_tb_data_pipeline(ai_mysql, ai_hive, tb_name1, tb_name2, last_time, partition_col, local_path, log,
+                          read_workers=2, prefetch=2, source_limit=None, state=None):
+    """
+    back_tb_data 的流水线版本：读MySQL和导hive重叠执行.
+    多个线程提前从MySQL读取后面的分区，当前线程按顺序把读好的分区导入hive，
+    这样第k个分区导入hive的时候，第k+1个分区已经在从MySQL读取了。
+
+    注意，impyla的连接不是线程安全的，所以hive只在当前线程里使用，读线程只碰MySQL连接池。
+
+    :param read_workers: 同时读取MySQL分区的线程数，即分区级并行度
+    :param prefetch: 已经读取但还没导入hive的分区数上限，控制内存占用，不会小于read_workers
+    :param source_limit: 同一个MySQL源的并发连接数限制（threading.BoundedSemaphore），多个表之间共享
+    :param state: backup_state 状态库，如果传入，则记录分区检查点，跳过已经完成或者其他进程正在备份的分区
+    :return: 备份的数据量和分区数 (rows, partition_cnt)
+    """
+    all_partitions = get_backup_partitions(ai_mysql, tb_name1, last_time, partition_col)
+    log.info('还需要备份的分区是：\n' + log.create_pretty_table(all_partitions))
+    exist_hive_col = prepare_hive_columns(ai_mysql, ai_hive, tb_name1, tb_name2, partition_col, all_partitions)
+    tasks = [partition_select_sql(tb_name1, partition_col, all_partitions.iloc[i].tolist())
+             for i in range(len(all_partitions))]
+    # 跳过上次已经完成的分区
+    if state is not None:
+        state.begin_round(tb_name1, [partition_value for _, partition_value in tasks])
+        done = state.done_partitions(tb_name1)
+        tasks = [task for task in tasks if state.partition_key(task[1]) not in done]
+        log.info('%s 有 %d 个分区上次已经完成，跳过' % (tb_name1, len(all_partitions) - len(tasks)))
+    tasks = iter(tasks)
+
+    def read_partition(mysql_sql):
+        """读线程：受源连接数限制地读取一个分区"""
+        if source_limit is None:
+            return ai_mysql.read_table(sql=mysql_sql)
+        with source_limit:
+            return ai_mysql.read_table(sql=mysql_sql)
+
+    def submit_next(pool, pending):
+        """提交下一个分区的读取任务，没有了就返回False"""
+        for mysql_sql, partition_value in tasks:
+            # 其他进程正在备份这个分区
+            if state is not None and not state.claim_partition(tb_name1, partition_value):
+                log.info('%s 的 partition=%s 正在被其他进程备份，跳过' % (tb_name1, str(partition_value)))
+                continue
+            pending.append((mysql_sql, partition_value, pool.submit(read_partition, mysql_sql)))
+            return True
+        return False
+
+    rows = 0
+    pending = deque()
+    error = 'cancelled'
+    pool = ThreadPoolExecutor(max_workers=read_workers)
+    try:
+        # 先提交prefetch个分区的读取任务
+        while len(pending) < max(prefetch, read_workers) and submit_next(pool, pending):
+            pass
+        # 按分区顺序导入hive，每取走一个就补充一个读取任务
+        while pending:
+            mysql_sql, partition_value, future = pending[0]
+            df = future.result()
+            submit_next(pool, pending)
+            log.info('SQL：%s' % mysql_sql)
+            log.info('读取 %s 表的 partition=%s 的数据，数据量：%d' % (tb_name1, str(partition_value), len(df)))
+            sub_rows = load_partition_into_hive(ai_hive, df, tb_name1, tb_name2, partition_col, partition_value,
+                                                exist_hive_col, local_path, log)
+            pending.popleft()
+            rows += sub_rows
+            if state is not None:
+                state.finish_partition(tb_name1, partition_value, sub_rows)
+    except:
+        error = traceback.format_exc().strip().split('\n')[-1]
+        raise
+    finally:
+        # 出错时取消还没开始的读取任务，已经抢占的分区释放掉
+        for _, partition_value, future in pending:
+            future.cancel()
+            if state is not None:
+                state.fail_partition(tb_name1, partition_value, error)
+        pool.shutdown(wait=True)
     log.info('完成 %s 的所有分区备份' % tb_name1)
+    return rows, len(all_partitions)
+
+
+def merge_changed_rows(existing, changed, key_col):
+    """
+    将变化的数据合并到hive分区的已有数据：已有数据中key相同的行被变化的数据替换，其他行保留。
+    key比较时统一转成字符串，因为hive和MySQL读出来的数据类型不一定一致。
+    hive的字段名都是小写，MySQL的字段名可能有大写，统一转成小写再对应。
+    """
+    changed = changed.rename(columns=str.lower)
+    key_col = [col.lower() for col in key_col]
+    if len(existing) == 0:
+        return changed
+    existing_key = existing[key_col].astype(str).apply(tuple, axis=1)
+    changed_key = set(changed[key_col].astype(str).apply(tuple, axis=1))
+    kept = existing.loc[~existing_key.isin(changed_key)]
+    return pd.concat([kept, changed.loc[:, existing.columns]], ignore_index=True)
+
+
+def merge_partition(ai_hive, sub_changed, tb_name1, tb_name2, partition_col, partition_value, hive_sql, key_col,
+                    local_path, log):
+    """将一个分区变化的数据合并到hive分区，有主键按主键替换，没有主键直接追加，返回变化的数据量"""
+    if key_col:
+        # 按主键替换：读取hive分区已有的数据，合并后覆盖分区
+        existing = ai_hive.read_table(sql=hive_sql)
+        merged = merge_changed_rows(existing, sub_changed, key_col)
+        log.info('hive分区 partition=%s 已有数据量：%d，合并后数据量：%d' %
+                 (str(partition_value), len(existing), len(merged)))
+        load_partition_into_hive(ai_hive, merged, tb_name1, tb_name2, partition_col, partition_value,
+                                 [], local_path, log)
+    else:
+        # 只插入不更新的表，直接追加
+        load_partition_into_hive(ai_hive, sub_changed, tb_name1, tb_name2, partition_col, partition_value,
+                                 [], local_path, log, overwrite=False)
+    return len(sub_changed)
+
+
+def is_number(value):
+    """水位是不是数字（自增id），否则认为是时间戳"""
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def back_tb_data_incremental(ai_mysql, ai_hive, tb_name1, tb_name2, watermark_col, watermark, partition_col,
+                             local_path, log, key_col=None, lookback_seconds=300, state=None):
+    """
+    增量（CDC）备份：只取出高水位之后变化的数据，合并到对应的hive分区，而不是重新读取整个分区。
+    :param watermark_col: 高水位字段，更新时间戳（update_time）或者自增id
+    :param watermark: 上次备份到的水位，None表示第一次备份，取全部数据
+    :param key_col: 主键字段，list。
+                    如果指定，变化的数据按主键替换hive分区里的旧数据（需要重新读取这个hive分区），
+                    取数从 watermark 往前 lookback_seconds 秒开始（自增id则包含 watermark 本身），重复取到的数据合并后不变;
+                    如果不指定，说明是只插入不更新的表，变化的数据直接追加到hive分区，重复取到的数据会重复追加，
+                    所以 watermark_col 必须是自增id，只取大于 watermark 的数据.
+    :param lookback_seconds: 有主键时，时间戳水位往前回看的秒数
+    :param state: backup_state 状态库，如果传入，每个分区合并完成后记录检查点，
+                  失败重跑时沿用上次的水位上限，跳过已经合并的分区。水位由 state.finish_table 更新
+    :return: (rows, partition_cnt, new_watermark)
+    注意，MySQL里被物理删除的数据是感知不到的，需要定期做一次全量备份。
+    """
+    # 上次没有完成的一轮留下的检查点（完成的、失败的都算），检查点的第一个值是那一轮的水位上限
+    checkpoints = state.checkpoints(tb_name1) if state is not None else {}
+    done = set([key for key, status in checkpoints.items() if status == 'done'])
+    # 优先用有分区已经完成的那一轮的水位上限，那些分区已经合并了，只有沿用它才能跳过
+    round_watermark = [key.split('|')[0][len('watermark='):] for key in sorted(checkpoints, key=lambda k: k not in done)
+                       if key.startswith('watermark=')]
+    if round_watermark:
+        # 沿用上一轮的水位上限，已经合并的分区数据不变，可以跳过；其他水位上限的旧检查点在 finish_table 时清除
+        new_watermark = round_watermark[0]
+        log.info('表 %s 上次增量备份没有完成，沿用水位上限：%s' % (tb_name1, new_watermark))
+    else:
+        # 先确定这次备份的水位上限，避免备份过程中新写入的数据只备份了一半
+        max_sql = "select max(%s) as watermark from %s" % (watermark_col, tb_name1)
+        new_watermark = ai_mysql.read_table(sql=max_sql)['watermark'].iat[0]
+        if new_watermark is None or pd.isnull(new_watermark):
+            log.info('表 %s 没有数据，不需要增量备份' % tb_name1)
+            if state is not None:
+                state.begin_round(tb_name1, [])
+            return 0, 0, watermark
+        new_watermark = str(new_watermark)
+    if not key_col and not is_number(new_watermark):
+        raise Exception('表 %s 没有配置主键 key_col，只能追加，高水位字段 %s 必须是自增id' % (tb_name1, watermark_col))
+    # 取出水位区间的变化数据：没有主键 (watermark, new_watermark]，有主键 [watermark - 回看, new_watermark]
+    condition = "%s <= '%s'" % (watermark_col, new_watermark)
+    if watermark is not None and not key_col:
+        condition = "%s > '%s' and %s" % (watermark_col, watermark, condition)
+    elif watermark is not None:
+        start = watermark
+        if lookback_seconds and not is_number(watermark):
+            start = str(pd.to_datetime(watermark) - datetime.timedelta(seconds=lookback_seconds))[:19]
+        condition = "%s >= '%s' and %s" % (watermark_col, start, condition)
+    changed_sql = "select * from %s where %s" % (tb_name1, condition)
+    changed = ai_mysql.read_table(sql=changed_sql)
+    log.info('SQL：%s' % changed_sql)
+    log.info('表 %s 水位 %s 到 %s 之间变化的数据量：%d' % (tb_name1, watermark, new_watermark, len(changed)))
+    if len(changed) == 0:
+        if state is not None:
+            state.begin_round(tb_name1, [])
+        return 0, 0, new_watermark
+    # 变化数据涉及到的分区
+    for col in partition_col:
+        changed[col] = changed[col].apply(str)
+    all_partitions = changed.loc[:, partition_col].drop_duplicates().reset_index(drop=True)
+    if state is not None:
+        # 这一轮的分区检查点带上水位上限
+        state.begin_round(tb_name1, [('watermark=%s' % new_watermark,) + tuple(all_partitions.iloc[i].tolist())
+                                     for i in range(len(all_partitions))])
+    log.info('需要合并的分区是：\n' + log.create_pretty_table(all_partitions))
+    exist_hive_col = prepare_hive_columns(ai_mysql, ai_hive, tb_name1, tb_name2, partition_col, all_partitions)
+    if len(exist_hive_col):
+        changed = add_cols_that_not_exists_mysql(changed, exist_hive_col)
+    # 逐个分区合并
+    rows = 0
+    for _, sub_changed in changed.groupby(partition_col, sort=False):
+        hive_sql, partition_value = partition_select_sql(tb_name2, partition_col,
+                                                         sub_changed.iloc[0][partition_col].tolist())
+        # 检查点带上这一轮的水位上限
+        checkpoint = ('watermark=%s' % new_watermark,) + partition_value
+        if state is not None:
+            if state.partition_key(checkpoint) in done:
+                log.info('%s 的 partition=%s 上次已经合并，跳过' % (tb_name1, str(partition_value)))
+                continue
+            if not state.claim_partition(tb_name1, checkpoint):
+                log.info('%s 的 partition=%s 正在被其他进程合并，跳过' % (tb_name1, str(partition_value)))
+                continue
+            try:
+                rows += merge_partition(ai_hive, sub_changed, tb_name1, tb_name2, partition_col, partition_value,
+                                        hive_sql, key_col, local_path, log)
+            except:
+                state.fail_partition(tb_name1, checkpoint, traceback.format_exc().strip().split('\n')[-1])
+                raise
+            state.finish_partition(tb_name1, checkpoint, len(sub_changed))
+        else:
+            rows += merge_partition(ai_hive, sub_changed, tb_name1, tb_name2, partition_col, partition_value,
+                                    hive_sql, key_col, local_path, log)
+    log.info('完成 %s 的增量备份，水位更新为：%s' % (tb_name1, new_watermark))
+    return rows, len(all_partitions), new_watermark
 
 
 class demo_config():
@@ -8,7 +8,12 @@ import os
 import platform
 import shutil
 import datetime
+import importlib.util
 import sys as sys
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pandas import concat, DataFrame
 
 
@@ -144,6 +149,228 @@ class pyos():
         shutil.copytree(source, target)
 
 
+####################################################################################################
+# 压缩的pickle格式：
+# MAGIC + 头部长度(8字节) + 头部(pickle的dict) + 所有压缩块
+# 对象用 pickle protocol 5 序列化，numpy数组等大块内存作为 out-of-band buffer 单独拿出来，不拷贝进pickle，
+# pickle本身和每个buffer切成 4M 的块，多线程压缩/解压（压缩库会释放GIL），读取时直接解压到buffer中。
+PICKLE_MAGIC = b'PYPICKLE5\n'
+PICKLE_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def _get_codec(codec):
+    """返回 (compress, decompress) 函数，lz4/zstd 用 pyarrow 自带的压缩库，zlib 是标准库，不依赖pyarrow"""
+    if codec == 'zlib':
+        return (lambda b: zlib.compress(b, 1)), (lambda b, n: zlib.decompress(b))
+    if codec in ('lz4', 'zstd'):
+        import pyarrow as pa
+        c = pa.Codec(codec)
+        return (lambda b: c.compress(b, asbytes=True)), (lambda b, n: c.decompress(b, decompressed_size=n))
+    raise Exception('不支持的压缩方式：%s，只能是 lz4、zstd、zlib' % codec)
+
+
+def default_codec():
+    """安装了pyarrow就用lz4，压缩和解压都很快，否则用zlib"""
+    return 'lz4' if importlib.util.find_spec('pyarrow') is not None else 'zlib'
+
+
+def dump_pickle(data, f, compress='lz4', n_threads=4):
+    """
+    将对象压缩序列化写到打开的二进制文件f，格式参见上面的说明。
+    :param compress: lz4（默认，最快）、zstd（压缩率更高）、zlib（不依赖pyarrow）
+    :param n_threads: 压缩的线程数
+    """
+    compress_func = _get_codec(compress)[0]
+    buffers = []
+    main = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+    segments = [memoryview(main)] + [b.raw() for b in buffers]
+    blocks = [seg[i: i + PICKLE_BLOCK_SIZE] for seg in segments for i in range(0, max(seg.nbytes, 1), PICKLE_BLOCK_SIZE)]
+    with ThreadPoolExecutor(n_threads) as executor:
+        compressed = list(executor.map(compress_func, blocks))
+    # 头部记录每一段有几个块，每个块压缩前后的大小
+    header, k = {'codec': compress, 'segments': []}, 0
+    for seg in segments:
+        cnt = len(range(0, max(seg.nbytes, 1), PICKLE_BLOCK_SIZE))
+        header['segments'].append([(blocks[j].nbytes, len(compressed[j])) for j in range(k, k + cnt)])
+        k += cnt
+    header = pickle.dumps(header, protocol=4)
+    f.write(PICKLE_MAGIC)
+    f.write(struct.pack('<Q', len(header)))
+    f.write(header)
+    for b in compressed:
+        f.write(b)
+
+
+def load_pickle(f, n_threads=4):
+    """读取 dump_pickle 写的文件，不是压缩格式的话按普通pickle读取"""
+    if f.read(len(PICKLE_MAGIC)) != PICKLE_MAGIC:
+        f.seek(0)
+        return pickle.load(f)
+    header = pickle.loads(f.read(struct.unpack('<Q', f.read(8))[0]))
+    decompress_func = _get_codec(header['codec'])[1]
+    # 先把所有压缩块读进来，再多线程解压到每一段的buffer中
+    segments, tasks = [], []
+    for seg_blocks in header['segments']:
+        buf = bytearray(sum(raw for raw, comp in seg_blocks))
+        view, offset = memoryview(buf), 0
+        for raw, comp in seg_blocks:
+            tasks.append((view[offset: offset + raw], f.read(comp)))
+            offset += raw
+        segments.append(buf)
+
+    def unpack(task):
+        target, block = task
+        target[:] = memoryview(decompress_func(block, target.nbytes)).cast('B')
+
+    with ThreadPoolExecutor(n_threads) as executor:
+        list(executor.map(unpack, tasks))
+    tasks = None
+    return pickle.loads(segments[0], buffers=segments[1:])
+
+
+def benchmark_pickle(path, df=None, n_threads=4):
+    """
+    比较普通pickle和各种压缩方式的文件大小和读写速度，返回结果表。
+    :param path: 测试文件存放的目录，最好和 ex_data 在同一块磁盘上
+    :param df: 测试数据，默认是 200万行 的数值、类别、字符串混合的dataframe
+    """
+    if df is None:
+        import numpy as np
+        n = 2000000
+        df = DataFrame({'id': np.arange(n), 'qty': np.random.randint(0, 100, n), 'price': np.random.rand(n) * 100,
+                        'feature': np.random.randn(n).round(3), 'cat': np.random.choice(['a', 'b', 'c'], n),
+                        'sku': ['SKU%07d' % (i % 50000) for i in range(n)]})
+    mb = df.memory_usage(deep=True).sum() / 1024 / 1024
+    file = os.path.join(path, 'benchmark_pickle.tmp')
+    result = []
+    for compress in [None, 'zlib', 'lz4', 'zstd']:
+        try:
+            _get_codec(compress) if compress else None
+        except ImportError:
+            continue
+        t = time.time()
+        with open(file, 'wb') as f:
+            if compress:
+                dump_pickle(df, f, compress, n_threads)
+            else:
+                pickle.dump(df, f, protocol=4)
+        write_time = time.time() - t
+        size = os.path.getsize(file) / 1024 / 1024
+        t = time.time()
+        with open(file, 'rb') as f:
+            load_pickle(f, n_threads)
+        read_time = time.time() - t
+        result.append({'compress': compress or 'pickle', 'size_mb': round(size, 1), 'ratio': round(mb / size, 2),
+                       'write_mb_s': round(mb / write_time, 1), 'read_mb_s': round(mb / read_time, 1)})
+    os.remove(file)
+    result = DataFrame(result)
+    print('测试数据 %d 行，内存 %.1f MB\n%s' % (len(df), mb, result.to_string(index=False)))
+    return result
+
+
+####################################################################################################
+def deep_size(obj, seen=None):
+    """
+    对象实际占用的内存（字节），sys.getsizeof 只算容器本身，这里会递归计算：
+    dataframe/series/index 用 memory_usage(deep=True)，numpy数组用 nbytes，dict/list/tuple/set 递归计算每个元素，
+    同一个对象被多次引用时只算一次。
+    """
+    import numpy as np
+    import pandas as pd
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, (pd.Series, pd.Index)):
+        return int(obj.memory_usage(deep=True))
+    if isinstance(obj, np.ndarray):
+        size = sys.getsizeof(obj)
+        if obj.base is not None:
+            size += obj.nbytes  # 视图的getsizeof不包含数据
+        if obj.dtype == object:
+            size += sum(deep_size(x, seen) for x in obj.flat)
+        return size
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(x, seen) for x in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(vars(obj), seen)
+    return size
+
+
+def format_size(size):
+    """字节数转成 Gb/Mb/Kb/Byte 的字符串"""
+    kb = 1024
+    mb = kb * 1024
+    gb = mb * 1024
+    if size > gb:
+        return '%.2fGb' % (size / gb)
+    if size > mb:
+        return '%.2fMb' % (size / mb)
+    if size > kb:
+        return '%.2fKb' % (size / kb)
+    return '%.2fByte' % size
+
+
+def dtype_advice(df, category_ratio=0.5, float_decimals=6):
+    """
+    分析dataframe每一列的内存，给出可以节省内存的类型转换建议，返回建议表（只包含能节省内存的列）。
+    整数列：按取值范围降到 int8/int16/int32 或者 uint*；
+    浮点列：float32 只有7位左右有效数字，相对误差总是很小，所以按数据本身的小数位数判断：
+        找到数据实际用到的小数位数 d（不超过 float_decimals），转成 float32 再四舍五入到 d 位能还原的，建议 float32；
+        整数值的浮点列（d=0）要求转回 float64 完全相等；找不到 d 的按绝对误差 0.5e-float_decimals 判断；
+    字符串列：不同值的个数占比小于 category_ratio 的，建议 category。
+    projected 是按建议转换后实际的内存大小。
+    """
+    import numpy as np
+    import pandas as pd
+    result = []
+    for col in df.columns:
+        s = df[col]
+        current = s.memory_usage(deep=True, index=False)
+        new = None
+        if pd.api.types.is_bool_dtype(s) or isinstance(s.dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_integer_dtype(s):
+            new = pd.to_numeric(s, downcast='unsigned' if len(s) and s.min() >= 0 else 'integer')
+        elif pd.api.types.is_float_dtype(s) and s.dtype.itemsize > 4:
+            with np.errstate(over='ignore'):
+                s32 = s.astype(np.float32)  # 超出float32范围的变成inf，下面按不能转处理
+            values = s.values[np.isfinite(s.values)]
+            values32 = s32.values.astype(np.float64)[np.isfinite(s.values)]
+            decimals = next((d for d in range(float_decimals + 1) if np.array_equal(np.round(values, d), values)), None)
+            if decimals is not None:
+                ok = np.array_equal(np.round(values32, decimals), values)
+            else:
+                ok = np.allclose(values32, values, rtol=0, atol=0.5 * 10 ** -float_decimals)
+            if ok and np.array_equal(np.isfinite(s.values), np.isfinite(s32.values)):
+                new = s32
+        elif pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s):
+            if len(s) and s.nunique(dropna=False) / len(s) < category_ratio:
+                new = s.astype('category')
+        if new is None or new.dtype == s.dtype:
+            continue
+        projected = new.memory_usage(deep=True, index=False)
+        if projected < current:
+            result.append({'column': col, 'dtype': str(s.dtype), 'advice': str(new.dtype), 'current': current,
+                           'projected': projected, 'saving': current - projected})
+    result = pd.DataFrame(result, columns=['column', 'dtype', 'advice', 'current', 'projected', 'saving'])
+    if len(result):
+        total = df.memory_usage(deep=True).sum()
+        print('一共 %s，按建议转换后可以节省 %s（%.1f%%）' % (format_size(total), format_size(result['saving'].sum()),
+                                                   result['saving'].sum() / total * 100))
+    return result.sort_values('saving', ascending=False).reset_index(drop=True)
+
+
+def apply_dtype_advice(df, advice):
+    """按 dtype_advice 的建议转换类型，返回新的dataframe"""
+    return df.astype(dict(zip(advice['column'], advice['advice'])))
+
+
 ####################################################################################################
 class pypickle():
     """pickle工具封装"""
@@ -159,31 +386,23 @@ class pypickle():
             print('父目录不存在，将创建：%s' % p_path)
 
     def object_size(self, object):
-        """对象的内存大小"""
-        size = sys.getsizeof(object)
-        b = 1
-        kb = b * 2014
-        mb = kb * 1024
-        gb = mb * 1024
-        if size > gb:
-            return '%.2fGb' % (size / gb)
-        if size > mb:
-            return '%.2fMb' % (size / mb)
-        if size > kb:
-            return '%.2fKb' % (size / kb)
-        else:
-            return '%.2fByte' % (size / b)
+        """对象的内存大小，包括dataframe、numpy数组和嵌套容器里面的数据，参见 deep_size"""
+        return format_size(deep_size(object))
 
-    def read(self, path):
-        """读取pickle数据"""
+    def read(self, path, n_threads=4):
+        """读取pickle数据，普通pickle和 write(compress=...) 写的压缩格式都可以读"""
         if not os.path.exists(path):
             raise Exception('找不到文件：' + path)
         with open(path, 'rb') as f:
-            data = pickle.load(f)
+            data = load_pickle(f, n_threads)
         return data
 
-    def write(self, path, data):
-        """将数据写到picker中"""
+    def write(self, path, data, compress=None, n_threads=4):
+        """
+        将数据写到picker中
+        :param compress: 是否压缩，None 不压缩，lz4、zstd、zlib 参见 dump_pickle，'default' 参见 default_codec
+        :param n_threads: 压缩的线程数
+        """
         # 存在，但是允许覆盖，则先删除该文件或者文件夹
         if os.path.exists(path) and os.path.isdir(path):
             raise Exception('指定的路径是已经存在的文件夹，贸然删除文件夹可能会导致问题，请手动删除或修改路径')
@@ -195,37 +414,41 @@ class pypickle():
         self.mkdir_if_not_exists(path)
         # 最后才是写
         with open(path, 'wb') as f:
-            pickle.dump(data, f)
+            if compress:
+                dump_pickle(data, f, default_codec() if compress == 'default' else compress, n_threads)
+            else:
+                pickle.dump(data, f)
 
     def write_big_df(self, path, df, per_time=500000):
-        """如果dataframe很大，比如300w*500的矩阵，占用10G内存，那将是很可怕的，所以需要另外处理，使用流式方法处理"""
+        """
+        如果dataframe很大，比如300w*500的矩阵，占用10G内存，那将是很可怕的，所以需要另外处理，使用流式方法处理
+        建议改用 pyarrow_df，可以追加、只读部分列、只读部分数据块、内存映射读取
+        """
         # 如果文件已存在，则删除
         if os.path.exists(path):
             os.remove(path)
             print('文件已存在，将删除：%s' % path)
-        for i in range(0, len(df), per_time):
-            with open(path, 'ab') as f:
+        with open(path, 'ab') as f:
+            for i in range(0, len(df), per_time):
                 pickle.dump(df.iloc[i: i + per_time], f)
                 print('将第 %d 个 %d 万行数据块序列化保存' % (i / per_time, per_time / 10000))
         return
 
     def read_big_df(self, path):
         """读取大dataframe的pickle文件，如果确实很大，内存很紧张，可能会出现内存错误问题，所以能不用就不用吧"""
-        df = DataFrame()
-        f = open(path, 'rb')
-        try:
-            i = 0
+        all_df = []
+        i = 0
+        with open(path, 'rb') as f:
             while True:
-                sub_df = pickle.load(f)
-                df = concat([df, sub_df])
+                try:
+                    sub_df = pickle.load(f)
+                except EOFError:
+                    break
+                all_df.append(sub_df)
                 cnt = len(sub_df)
                 print('读取第 %.2f - %.2f 万行数据' % (i / 10000, (i + cnt) / 10000))
                 i = i + cnt
-        except:
-            pass
-        finally:
-            f.close()
-        return df
+        return concat(all_df) if all_df else DataFrame()
 
 
 def _test_pickle():
@@ -239,6 +462,115 @@ def _test_pickle():
     print(b)
 
 
+###############################################################################################
+class pyarrow_df():
+    """
+    大dataframe的分块列式存储，代替 pypickle.write_big_df，需要安装 pyarrow。
+    path 是一个目录，每次写入（write/append）生成一个 arrow IPC 文件（part_00000.arrow ...），
+    每个文件里面每 per_time 行是一个数据块（record batch），所有文件的数据块按顺序编号。
+    读取时使用内存映射，只读取需要的列和数据块，数值列不需要反序列化，10G的特征矩阵也能很快加载部分数据。
+    """
+
+    def __init__(self):
+        import pyarrow  # 没有安装pyarrow的话，创建对象时就报错
+        self.pa = pyarrow
+
+    def _part_files(self, path):
+        """目录下的所有分块文件，按写入顺序排序"""
+        if not os.path.isdir(path):
+            raise Exception('找不到数据目录：%s' % path)
+        return [os.path.join(path, f) for f in sorted(os.listdir(path))
+                if f.startswith('part_') and f.endswith('.arrow')]
+
+    def write(self, path, df, per_time=500000):
+        """将dataframe写到目录path，目录已存在的话先删除"""
+        if os.path.exists(path):
+            print('数据目录已存在，将删除：%s' % path)
+            shutil.rmtree(path)
+        os.makedirs(path)
+        self.append(path, df, per_time)
+
+    def append(self, path, df, per_time=500000):
+        """追加一个dataframe，字段要和已有的数据一致，生成一个新的分块文件，不改写已有的文件"""
+        if not os.path.exists(path):
+            os.makedirs(path)
+        all_files = self._part_files(path)
+        table = self.pa.Table.from_pandas(df, preserve_index=True)
+        if all_files:
+            schema = self.pa.ipc.open_file(self.pa.memory_map(all_files[0], 'r')).schema
+            if not schema.equals(table.schema, check_metadata=False):
+                raise Exception('追加的数据和已有数据的字段不一致：\n%s\n%s' % (schema, table.schema))
+        file = os.path.join(path, 'part_%05d.arrow' % len(all_files))
+        with self.pa.OSFile(file + '.tmp', 'wb') as sink:
+            with self.pa.ipc.new_file(sink, table.schema) as writer:
+                for batch in table.to_batches(max_chunksize=per_time):
+                    writer.write_batch(batch)
+        os.replace(file + '.tmp', file)  # 写完才改名，读的时候不会读到写了一半的文件
+        print('保存 %d 行数据到：%s' % (len(df), file))
+
+    def chunks(self, path):
+        """所有数据块的信息 [(数据块编号, 文件, 文件内的序号, 行数), ...]，只读取文件尾部的元数据"""
+        result = []
+        for file in self._part_files(path):
+            reader = self.pa.ipc.open_file(self.pa.memory_map(file, 'r'))
+            for i in range(reader.num_record_batches):
+                result.append((len(result), file, i, reader.get_batch(i).num_rows))
+        return result
+
+    def read_table(self, path, columns=None, chunks=None):
+        """
+        内存映射读取，返回 pyarrow.Table，数据直接指向映射的文件，不拷贝。
+        :param columns: 只读取这些列，None 表示全部
+        :param chunks: 只读取这些编号的数据块（参见 chunks），比如 range(10, 20)，None 表示全部
+        """
+        chunks = None if chunks is None else set(chunks)
+        all_batch = []
+        schema = None
+        n = 0
+        for file in self._part_files(path):
+            reader = self.pa.ipc.open_file(self.pa.memory_map(file, 'r'))
+            schema = reader.schema
+            for i in range(reader.num_record_batches):
+                if chunks is None or n in chunks:
+                    all_batch.append(reader.get_batch(i))
+                n += 1
+        if schema is None:
+            raise Exception('数据目录下没有数据文件：%s' % path)
+        return self._select(self.pa.Table.from_batches(all_batch, schema=schema), columns)
+
+    def read(self, path, columns=None, chunks=None):
+        """读取成dataframe，参数参见 read_table；没有空值的数值列尽量不拷贝"""
+        return self.read_table(path, columns, chunks).to_pandas(split_blocks=True, self_destruct=True)
+
+    def iter_read(self, path, columns=None):
+        """逐个数据块读取，每次返回一个dataframe，内存中只保留一个数据块"""
+        for file in self._part_files(path):
+            reader = self.pa.ipc.open_file(self.pa.memory_map(file, 'r'))
+            for i in range(reader.num_record_batches):
+                table = self.pa.Table.from_batches([reader.get_batch(i)])
+                yield self._select(table, columns).to_pandas(split_blocks=True, self_destruct=True)
+
+    @staticmethod
+    def _select(table, columns):
+        """只保留需要的列，索引列也要带上，否则 to_pandas 后索引会丢失"""
+        if columns is None:
+            return table
+        metadata = table.schema.pandas_metadata
+        index_cols = [c for c in metadata.get('index_columns', []) if isinstance(c, str)] if metadata else []
+        return table.select(list(columns) + [c for c in index_cols if c not in columns])
+
+
+def _test_pyarrow_df():
+    import numpy as np
+    pyadf = pyarrow_df()
+    path = '/home/zhenyu/big_df'
+    df = DataFrame(np.random.rand(1000, 5), columns=['a', 'b', 'c', 'd', 'e'])
+    pyadf.write(path, df, per_time=300)
+    pyadf.append(path, df, per_time=300)
+    print(pyadf.chunks(path))
+    print(pyadf.read(path, columns=['a', 'b'], chunks=range(2, 5)))
+
+
 ###############################################################################################
 class pyjson():
     """json读写，主要针对dict数据"""
@@ -19,15 +19,87 @@ hdf5的格式是：
 在这里的场景，一般情况下，key1是日期，也即是存储多天的日期数据。
 
 约定，日期必须是 '20180101' 格式，不能是 ''的格式
+
+默认每个key都是 fixed 格式，读取时只能整个key全部读出来。
+需要按sku、门店等字段查询某一天的部分数据时，用 format='table' 写入（或者用 append 追加），
+并指定 data_columns（可以在where中查询的字段，会建索引）：
+    hdf5.write('tb.h5', df, key='20181010', format='table', data_columns=['sku', 'store'])
+    hdf5.append('tb.h5', df2, key='20181010')
+    hdf5.read('tb.h5', key='20181010', where='sku == "A001"', columns=['sku', 'qty'])
+删除key之后文件不会变小，用 compact 重新打包文件，回收空间。
+
+多个进程同时读写同一个文件时（比如并行计算的子进程在读，另一个任务在追加），用 concurrent=True：
+1、读写都加文件锁（文件名.lock），读是共享锁，可以同时有多个进程在读；写是独占锁，写的时候其他进程不能读写
+2、读的时候以只读方式打开，每次读完就关闭
+3、HDF5库自带的文件锁会让缓存的只读句柄挡住其他进程的写入，PyTables又不能对单个文件关闭这个锁（HDF5只在加载时读一次
+   环境变量 HDF5_USE_FILE_LOCKING，对整个进程生效），所以这里不去改环境变量。需要缓存句柄的任务，在启动进程之前设置
+   HDF5_USE_FILE_LOCKING=FALSE（比如写在启动脚本里），这时每个进程缓存打开的文件，多次 read 不需要重新打开，
+   文件被写过（修改时间或大小变了）才重新打开；同一个进程的多个线程（比如 worker_pool 的 thread 后端）共用缓存的句柄，轮流读取。
+   关闭HDF5自带的文件锁后，所有读写同一个文件的进程都要用 concurrent=True，由这里的文件锁保证安全
 """
 import pandas as pd
 import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
 from ...config.config import ex_data
 
+try:
+    import fcntl  # linux下用fcntl实现读写锁，windows下没有，退化成filelock的独占锁
+except ImportError:
+    fcntl = None
+
+_store_cache = {}  # 缓存的只读文件句柄，文件路径 -> (进程id, 文件的修改时间和大小, HDFStore)
+_cache_lock = threading.RLock()  # PyTables/HDF5 不是线程安全的，同一个进程的多个线程轮流使用缓存的句柄
+
+
+@contextmanager
+def file_lock(lock_file, shared=False, timeout=3600):
+    """
+    文件锁，shared=True 是共享锁（读），否则是独占锁（写）。
+    linux下用 fcntl.flock，windows下用 filelock（和 pyconfig 一样），只有独占锁。
+    """
+    if fcntl is None:
+        from filelock import Timeout, FileLock
+        try:
+            with FileLock(lock_file).acquire(timeout=timeout):
+                yield
+        except Timeout:
+            raise Exception('文件锁超时：%s' % lock_file)
+        return
+    with open(lock_file, 'a') as f:
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        endtime = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(f, mode | fcntl.LOCK_NB)
+                break
+            except (BlockingIOError, PermissionError):
+                if time.time() > endtime:
+                    raise Exception('文件锁超时：%s' % lock_file)
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
 
 class pyhdf5():
-    def __init__(self, ex_data_path=None):
+    def __init__(self, ex_data_path=None, complevel=None, complib=None, concurrent=False, lock_timeout=3600):
+        """
+        :param ex_data_path: 数据存放目录
+        :param complevel: 默认的压缩级别 0-9，None 表示不压缩
+        :param complib: 默认的压缩库，比如 'blosc:lz4'（快）、'blosc:zstd'、'zlib'（兼容性最好）
+        :param concurrent: 多进程并发读写模式，参见模块说明（不会修改 HDF5_USE_FILE_LOCKING 环境变量）
+        :param lock_timeout: 等待文件锁的超时时间（秒）
+        """
         self.ex_data_path = ex_data_path if ex_data_path else ex_data  # 数据存放目录
+        self.complevel = complevel
+        self.complib = complib
+        self.concurrent = concurrent
+        self.lock_timeout = lock_timeout
 
     def date_str(self, statedate, types='encode'):
         """将statedate的横线取消或者添加，因为pytable中的名称不能有横线"""
@@ -52,43 +124,226 @@ class pyhdf5():
     def get_keys(self, hdf5):
         """获取HDF5文件的所有keys"""
         hdf5 = self.get_file_path(hdf5)
-        with pd.HDFStore(hdf5) as store:
+        with self._reader(hdf5) as store:
             all_keys = [k[2:] for k in store.keys()]  # 每个key都删除前面的 '/_'
             return all_keys
 
-    def read(self, hdf5, key='default'):
-        """读取某个分区（key）的数据"""
+    def read(self, hdf5, key='default', where=None, columns=None):
+        """
+        读取某个分区（key）的数据
+        :param where: 查询条件，比如 'sku == "A001" & qty > 0'，只能用于 table 格式，字段必须是 data_columns
+        :param columns: 只读取这些列，只能用于 table 格式
+        """
         hdf5 = self.get_file_path(hdf5)
         key = self.new_key(key)
-        with pd.HDFStore(hdf5) as store:
-            return store[key]
+        with self._reader(hdf5) as store:
+            if where is None and columns is None:
+                return store[key]
+            return store.select(key, where=where, columns=columns)
+
+    def read_range(self, hdf5, start=None, end=None, columns=None, where=None, date_col=None, iterator=False):
+        """
+        读取日期在 [start, end] 之间的所有分区（key是日期，比如 '20181010'），只打开一次文件
+        :param start: 开始日期，比如 '2018-10-01'，None 表示不限制
+        :param end: 结束日期（包含），None 表示不限制
+        :param columns: 只读取这些列；fixed 格式的分区读取后再取这些列
+        :param where: 查询条件，只能用于 table 格式的分区
+        :param date_col: 不为空时，在结果中添加这一列，值是分区的日期 'YYYY-MM-DD'
+        :param iterator: True 时返回生成器，按日期先后逐个返回 (日期, dataframe)，内存中只有一天的数据；
+                         生成器遍历完之前文件一直打开（concurrent 模式下一直持有读锁，本进程其他线程的读取也要等待），
+                         不要在遍历中写这个文件
+        :return: 所有日期的数据拼接成的一个dataframe
+        """
+        frames = self._iter_range(hdf5, start, end, columns, where, date_col)
+        if iterator:
+            return frames
+        frames = [df for _, df in frames]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames)
 
-    def write(self, hdf5, df, key='default'):
-        """将dataframe写到某个分区下面"""
+    def _iter_range(self, hdf5, start, end, columns, where, date_col):
+        """按日期先后逐个读取分区，不是 '20181010' 这种日期的key（比如 '2018'、'meta'）跳过"""
+        hdf5 = self.get_file_path(hdf5)
+        start = pd.Timestamp(start) if start is not None else pd.Timestamp.min
+        end = pd.Timestamp(end) if end is not None else pd.Timestamp.max
+        with self._reader(hdf5) as store:
+            dates = []
+            for k in store.keys():
+                day = pd.to_datetime(k[2:], format='%Y%m%d', errors='coerce')  # key是 date_str 编码的日期
+                if day is not pd.NaT and start <= day <= end:
+                    dates.append((day, k))
+            for day, k in sorted(dates):
+                if store.get_storer(k).is_table:
+                    df = store.select(k, where=where, columns=columns)
+                elif where is not None:
+                    raise Exception('fixed格式的分区不能用where查询：%s' % k)
+                else:
+                    df = store[k]
+                    if columns is not None:
+                        df = df[columns]
+                day = str(day)[:10]
+                if date_col is not None:
+                    df[date_col] = day
+                yield day, df
+
+    def write(self, hdf5, df, key='default', format='fixed', data_columns=None, complevel=None, complib=None,
+              min_itemsize=None):
+        """
+        将dataframe写到某个分区下面，已经存在的话覆盖
+        :param format: fixed 读写最快，只能整个读取；table 可以追加、按条件查询、只读部分列
+        :param data_columns: table格式下可以在where中查询的字段，会自动建索引，True 表示所有字段
+        :param complevel: 压缩级别，默认用创建对象时的设置
+        :param complib: 压缩库，默认用创建对象时的设置
+        :param min_itemsize: table格式下字符串字段的最小长度，比如 {'sku': 30}，以后追加的字符串不能超过这个长度
+        """
+        hdf5 = self.get_file_path(hdf5)
+        key = self.new_key(key)
+        with self._writer(hdf5, complevel, complib) as store:
+            if format == 'fixed':
+                store.put(key, df, format='fixed')
+            else:
+                store.put(key, df, format='table', data_columns=data_columns, min_itemsize=min_itemsize)
+
+    def append(self, hdf5, df, key='default', data_columns=None, complevel=None, complib=None, min_itemsize=None):
+        """
+        追加数据到某个分区（table格式），不需要重写已有数据。分区不存在时创建，参数参见 write；
+        已经存在的分区，字段要和原来的一致，data_columns 以第一次写入的为准
+        """
         hdf5 = self.get_file_path(hdf5)
         key = self.new_key(key)
-        with pd.HDFStore(hdf5) as store:
-            store[key] = df
+        with self._writer(hdf5, complevel, complib) as store:
+            store.append(key, df, format='table', data_columns=data_columns, min_itemsize=min_itemsize)
+
+    def create_index(self, hdf5, key='default', columns=None, optlevel=9, kind='full'):
+        """
+        给table格式的分区重建索引。大量 append 时可以先用 data_columns 写入，全部追加完后再建完整索引，查询更快
+        :param columns: 建索引的字段，None 表示所有 data_columns
+        """
+        hdf5 = self.get_file_path(hdf5)
+        key = self.new_key(key)
+        with self._writer(hdf5) as store:
+            store.create_table_index(key, columns=columns, optlevel=optlevel, kind=kind)
 
     def delete(self, hdf5, key='default'):
-        """删除某个分区下面的数据"""
+        """删除某个分区下面的数据，文件不会变小，参见 compact"""
         hdf5 = self.get_file_path(hdf5)
         key = self.new_key(key)
-        with pd.HDFStore(hdf5) as store:
+        with self._writer(hdf5) as store:
             del store[key]
 
-    def delete_old_data(self, hdf5, statedate, keepdays=5):
-        """对数据文件保留n天的历史数据"""
+    def delete_old_data(self, hdf5, statedate, keepdays=5, compact=False):
+        """对数据文件保留n天的历史数据，compact=True 时删除后重新打包文件，回收空间"""
         # statedate='2018-10-15'
         # keepdays=5
         hdf5 = self.get_file_path(hdf5)
-        keep_date = [str(day)[:10] for day in pd.date_range(end=statedate, periods=keepdays, freq='1D')]
-        all_keys = self.get_keys(hdf5)
-        delete_keys = [key for key in all_keys if key not in keep_date]
-        with pd.HDFStore(hdf5) as store:
+        # 数据的key是去掉横线的日期（_20181015），比较前两边都统一成 20181015 的格式
+        keep_date = [self.date_str(str(day)[:10]) for day in pd.date_range(end=statedate, periods=keepdays, freq='1D')]
+        with self._writer(hdf5) as store:
+            all_keys = [k[2:] for k in store.keys()]
+            delete_keys = [key for key in all_keys if self.date_str(key) not in keep_date]
             for key in delete_keys:
-                key = self.new_key(key)
-                del store[key]
+                del store[self.new_key(key)]
+        if compact and delete_keys:
+            self.compact(hdf5)
+
+    def compact(self, hdf5, complevel=None, complib=None):
+        """
+        用 ptrepack（PyTables自带）重新打包HDF5文件，把所有数据复制到新文件后替换原文件，回收删除数据后留下的空间。
+        可以同时修改压缩设置，不指定的话保留原来的压缩设置，table格式的索引会一起复制。
+        """
+        hdf5 = self.get_file_path(hdf5)
+        tmp_file = hdf5 + '.compact'
+        complevel, complib = self._complevel(complevel), self._complib(complib)
+        cmd = [sys.executable, '-c', 'from tables.scripts.ptrepack import main; main()',
+               '--overwrite', '--chunkshape=keep', '--propindexes']
+        if complevel:
+            cmd += ['--complevel=%d' % complevel, '--complib=%s' % (complib if complib else 'zlib')]
+        else:
+            cmd += ['--keep-source-filters']
+        with self._lock(hdf5, shared=False):
+            with _cache_lock:
+                self._close_cached(hdf5)
+            size1 = os.path.getsize(hdf5)
+            subprocess.run(cmd + [hdf5 + ':/', tmp_file + ':/'], check=True)
+            os.replace(tmp_file, hdf5)
+        print('重新打包文件 %s：%.1fMb -> %.1fMb' % (hdf5, size1 / 1024 / 1024, os.path.getsize(hdf5) / 1024 / 1024))
+
+    @contextmanager
+    def _lock(self, hdf5, shared):
+        """concurrent 模式下加文件锁，否则什么都不做"""
+        if not self.concurrent:
+            yield
+            return
+        with file_lock(hdf5 + '.lock', shared=shared, timeout=self.lock_timeout):
+            yield
+
+    @contextmanager
+    def _reader(self, hdf5):
+        """
+        以只读方式打开HDF5文件；concurrent 模式下加共享锁，启动前关闭了HDF5自带的文件锁时，
+        复用本进程缓存的句柄，用完之前其他线程要等待。文件不存在时和以前一样先创建一个空文件
+        """
+        if not os.path.exists(hdf5):
+            with self._writer(hdf5):
+                pass
+        if not self.concurrent:
+            with pd.HDFStore(hdf5, mode='r') as store:
+                yield store
+            return
+        with self._lock(hdf5, shared=True):
+            if os.environ.get('HDF5_USE_FILE_LOCKING', '').upper() != 'FALSE':
+                # HDF5自带的文件锁还开着，句柄不能留到锁外面，否则会挡住其他进程的写入
+                with pd.HDFStore(hdf5, mode='r') as store:
+                    yield store
+                return
+            with _cache_lock:
+                yield self._cached_store(hdf5)
+
+    @contextmanager
+    def _writer(self, hdf5, complevel=None, complib=None):
+        """打开HDF5文件用于写入，压缩设置对这次写入的数据生效；concurrent 模式下加独占锁"""
+        with self._lock(hdf5, shared=False):
+            with _cache_lock:
+                self._close_cached(hdf5)
+            with pd.HDFStore(hdf5, complevel=self._complevel(complevel), complib=self._complib(complib)) as store:
+                yield store
+
+    @staticmethod
+    def _cached_store(hdf5):
+        """本进程缓存的只读句柄，文件被写过或者是从父进程继承来的，就重新打开"""
+        path = os.path.abspath(hdf5)
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = _store_cache.get(path)
+        if cached is not None and cached[0] == os.getpid() and cached[1] == signature:
+            return cached[2]
+        pyhdf5._close_cached(path)
+        store = pd.HDFStore(path, mode='r')
+        _store_cache[path] = (os.getpid(), signature, store)
+        return store
+
+    @staticmethod
+    def _close_cached(hdf5):
+        """
+        关闭缓存的只读句柄。fork出来的子进程会继承父进程的句柄，PyTables 认为文件已经以只读方式打开，
+        不关掉的话子进程不能写这个文件；只读句柄关闭时不写文件，关闭子进程里的这份不影响父进程
+        """
+        cached = _store_cache.pop(os.path.abspath(hdf5), None)
+        if cached is not None:
+            cached[2].close()
+
+    def close(self):
+        """关闭本进程缓存的所有只读句柄"""
+        with _cache_lock:
+            for path in list(_store_cache):
+                self._close_cached(path)
+
+    def _complevel(self, complevel):
+        return complevel if complevel is not None else self.complevel
+
+    def _complib(self, complib):
+        return complib if complib is not None else self.complib
 
 
 def _test():
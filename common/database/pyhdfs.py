@@ -28,8 +28,8 @@ fs.listdir('/')
 
 该csv应该是中等大小数据集，能够在python内存进行csv的各种操作.
 
-你应该知道的是，如果直接返回dataframe，所有的数据类型都是string.
-因此要求，hdfs文件的数据，是非常标准，规范的数据，最好是全部的字段都是数值型，如果有字符串字段，要求保证没有逗号存在该字段中，切记切记切记。
+read_csv_from_hdfs 多线程读取各个数据文件，直接用 pandas.read_csv 解析字节流，字段类型由 read_csv 推断，也可以通过 dtype 指定.
+要求hdfs文件的数据，是非常标准，规范的数据，最好是全部的字段都是数值型，如果有字符串字段，要求保证没有逗号存在该字段中，切记切记切记。
 
 此外，你需要注意的是，一般hdfs_path路径看起来是一个文件名路径，其实是一个hdfs文件夹，里面有很多小文众多小文件最终组成一个我们看到的简单的csv文件。
 
@@ -38,23 +38,158 @@ fs.listdir('/')
 使用hive指定分隔符，而且保存格式为text file：
     create table tb_name row format delimited fields terminated by ',' stored as TEXTFILE  as select * from xxx
 
+orc和parquet格式的hive表，使用 read_hive_table 直接读取hdfs上的数据文件（需要安装pyarrow），支持字段裁剪和分区裁剪.
+
 """
 import datetime
+import gzip
+import hashlib
+import io
+import re
+import threading
 import time
 import pandas as pd
 import os
 import shutil
 import hdfs
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import check_output
+from urllib.parse import urlparse, unquote
 from ...config.config import cluster_ip
 from ...config.config import ex_data
 
+class hdfs_cache():
+    """
+    hdfs文件的本地缓存。同一个hive文本表一天内会被反复下载，而数据其实没有变化。
+    缓存的key是 hdfs路径+文件大小+修改时间（来自 status/walk），文件没有变化就直接用本地缓存，变化了才重新下载.
+    缓存文件按最近使用时间（文件的mtime）做LRU淘汰，总大小不超过 max_bytes。
+    用 use 读取缓存文件：使用期间本进程的淘汰不会删除它；其他进程的淘汰删掉了它，就当作没有缓存，重新下载。
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=50 * 1024 ** 3):
+        self.cache_dir = cache_dir if cache_dir else os.path.join(ex_data, 'hdfs_cache')
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pins = {}  # 正在使用的缓存文件 -> 使用次数，淘汰时跳过
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def cache_file(self, hdfs_file, status):
+        """根据hdfs路径、文件大小、修改时间得到缓存文件名"""
+        key = '%s|%s|%s' % (hdfs_file, status['length'], status['modificationTime'])
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, conn, hdfs_file, status):
+        """返回hdfs文件对应的本地缓存文件，没有缓存则先下载"""
+        file = self.cache_file(hdfs_file, status)
+        if os.path.exists(file):
+            try:
+                os.utime(file, None)  # 更新使用时间，用于LRU
+                return file
+            except FileNotFoundError:
+                pass  # 刚被其他进程淘汰，当作没有缓存
+        # 先下载到临时文件再改名，多个线程或进程同时下载同一个文件也不会读到一半的文件
+        tmp_file = '%s.%d.%d.tmp' % (file, os.getpid(), threading.get_ident())
+        conn.download(hdfs_file, tmp_file, overwrite=True)
+        os.replace(tmp_file, file)
+        self.evict()
+        return file
+
+    def use(self, conn, hdfs_file, status, action):
+        """
+        取得hdfs文件对应的本地缓存文件，执行 action(缓存文件) 并返回结果，比如硬链接或者 read_csv。
+        执行期间这个文件不会被本进程淘汰；其他进程在这期间淘汰了它（FileNotFoundError），重新下载一次
+        """
+        file = self.cache_file(hdfs_file, status)
+        with self._lock:
+            self._pins[file] = self._pins.get(file, 0) + 1
+        try:
+            try:
+                return action(self.get(conn, hdfs_file, status))
+            except FileNotFoundError:
+                return action(self.get(conn, hdfs_file, status))
+        finally:
+            with self._lock:
+                self._pins[file] -= 1
+                if self._pins[file] == 0:
+                    del self._pins[file]
+
+    def evict(self):
+        """总大小超过 max_bytes 时，删除最久没有使用的缓存文件，正在使用的文件不删除"""
+        with self._lock:
+            all_files = []
+            for entry in os.scandir(self.cache_dir):
+                try:
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        stat = entry.stat()
+                        all_files.append((stat.st_mtime, stat.st_size, entry.path))
+                except FileNotFoundError:
+                    continue  # 其他进程同时在淘汰
+            total = sum([size for _, size, _ in all_files])
+            for mtime, size, file in sorted(all_files):
+                if total <= self.max_bytes:
+                    break
+                if file in self._pins:
+                    continue
+                try:
+                    os.remove(file)  # 已经硬链接或者打开的文件不受影响
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+class webhdfs_file(io.RawIOBase):
+    """
+    把hdfs文件包装成可以seek的文件对象，每次read都是一个带offset和length的webhdfs请求。
+    parquet/orc读取时只需要文件尾部的元数据和需要的列，这样就不用把整个文件下载下来。
+    一般外面再包一层 io.BufferedReader，减少小请求的次数。
+    """
+
+    def __init__(self, conn, hdfs_file, length):
+        self._conn = conn
+        self._file = hdfs_file
+        self._length = length
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._length + offset
+        return self._pos
+
+    def readinto(self, b):
+        size = min(len(b), self._length - self._pos)
+        if size <= 0:
+            return 0
+        with self._conn.read(self._file, offset=self._pos, length=size) as reader:
+            data = reader.read()
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
 class pyhdfs():
-    def __init__(self, host='10.1.101.2', port='50070', encrypt=False):
+    def __init__(self, host='10.1.101.2', port='50070', encrypt=False, cache_dir=None, cache_max_bytes=50 * 1024 ** 3):
         self.host = host
         self.port = port
         self.encrypt = encrypt
         self.conn = self._init_connect()
+        self._cache_dir = cache_dir  # 本地缓存目录，None则使用 ex_data/hdfs_cache
+        self._cache_max_bytes = cache_max_bytes  # 本地缓存的最大字节数
+        self._cache = None
 
     def to_log(self, string, log=None):
         """打印"""
@@ -109,6 +244,136 @@ class pyhdfs():
         """上传数据"""
         return self.conn.upload(*args, **kwargs)
 
+    def _pack_parts(self, source, part_dir, target_size, compress, skip_header, sep, header):
+        """
+        将小文件或者dataframe合并成 target_size 左右大小（压缩前）的数据块文件，每写完一个就返回（生成器）.
+        :param source: 本地目录，或者dataframe的迭代器
+        """
+        # 把输入统一成字节块
+        if isinstance(source, str):
+            files = sorted([os.path.join(source, f) for f in os.listdir(source)
+                            if os.path.isfile(os.path.join(source, f))])
+
+            def all_bytes():
+                for file in files:
+                    with open(file, 'rb') as f:
+                        if skip_header:
+                            f.readline()
+                        content = f.read()
+                    if content and not content.endswith(b'\n'):
+                        content += b'\n'
+                    yield content
+        else:
+            def all_bytes():
+                # 表头只写在第一个数据块的开头
+                for i, df in enumerate(source):
+                    yield df.to_csv(index=False, header=header and i == 0, sep=sep).encode('utf-8')
+        # 合并
+        part_id, size, f = 0, 0, None
+        suffix = '.csv.gz' if compress else '.csv'
+        for content in all_bytes():
+            if f is None:
+                part_file = os.path.join(part_dir, 'part-%05d%s' % (part_id, suffix))
+                f = gzip.open(part_file, 'wb', compresslevel=1) if compress else open(part_file, 'wb')
+            f.write(content)
+            size += len(content)
+            if size >= target_size:
+                f.close()
+                yield part_file
+                part_id, size, f = part_id + 1, 0, None
+        if f is not None:
+            f.close()
+            yield part_file
+
+    def _verify_upload(self, hdfs_file, local_file, verify='size'):
+        """上传后校验：size 比较文件大小；md5 在大小一致的基础上，读回hdfs文件计算md5比较"""
+        local_size = os.path.getsize(local_file)
+        hdfs_size = self.conn.status(hdfs_file)['length']
+        if hdfs_size != local_size:
+            raise Exception('上传校验失败，文件大小不一致：%s(%d) --> %s(%d)' % (local_file, local_size, hdfs_file, hdfs_size))
+        if verify == 'md5':
+            local_md5, hdfs_md5 = hashlib.md5(), hashlib.md5()
+            with open(local_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+                    local_md5.update(chunk)
+            with self.conn.read(hdfs_file, chunk_size=8 * 1024 * 1024) as reader:
+                for chunk in reader:
+                    hdfs_md5.update(chunk)
+            if local_md5.hexdigest() != hdfs_md5.hexdigest():
+                raise Exception('上传校验失败，md5不一致：%s --> %s' % (local_file, hdfs_file))
+
+    def bulk_upload(self, hdfs_path, source, target_size=128 * 1024 * 1024, compress=True, n_threads=8,
+                    verify='size', skip_header=False, sep=',', header=False, overwrite=True, log=None):
+        """
+        批量上传：模型结果导出时有成千上万个sku的小文件，一个个upload太慢，hdfs也不喜欢小文件。
+        这里先把小文件（或者dataframe）合并成 target_size 左右的数据块，gzip压缩后多线程上传，上传完校验。
+        hive的text表可以直接读取 .gz 文件。
+        边合并边上传，本地最多同时有 n_threads*2 个等待上传的数据块，不会一次把所有数据块都写到本地磁盘。
+        先上传到 hdfs_path 下面的临时目录（下划线开头，hive不会读取），全部成功后删除 hdfs_path 下面原来的 part-* 文件，
+        再把新的数据块移进来，中途失败时原来的数据不受影响。
+        :param hdfs_path: hdfs目录
+        :param source: 本地目录（目录下的所有文件），或者dataframe的迭代器
+        :param target_size: 每个数据块压缩前的大小
+        :param compress: 是否gzip压缩
+        :param n_threads: 同时上传的文件数
+        :param verify: 上传后校验，size 只比较文件大小，md5 还会读回文件比较md5，None不校验
+        :param skip_header: 本地文件有表头时跳过每个文件的第一行，合并后的文件没有表头
+        :param sep: dataframe写成csv的分隔符
+        :param header: dataframe写成csv时是否带表头，只写在第一个数据块的开头，hive表不要表头
+        :param overwrite: 是否覆盖hdfs_path下面已有的 part-* 文件，False 时已有 part-* 文件就报错
+        :return: 上传的hdfs文件列表
+        """
+        self.ping()
+        t1 = time.time()
+        # 本地临时目录，存放合并后的数据块
+        part_dir = os.path.join(ex_data, '_bulk_upload_%s_%d' % (datetime.datetime.now().strftime('%Y%m%d_%H%M%S'),
+                                                                os.getpid()))
+        os.makedirs(part_dir)
+        hdfs_path = hdfs_path.rstrip('/')
+        if not self.exists(hdfs_path):
+            self.conn.makedirs(hdfs_path)
+        old_parts = [file for file in self.conn.list(hdfs_path) if file.startswith('part-')]
+        if old_parts and not overwrite:
+            raise Exception('hdfs目录 %s 下面已经有 %d 个 part-* 文件，overwrite=False 不能覆盖' % (hdfs_path, len(old_parts)))
+        tmp_path = '%s/_upload_tmp_%s' % (hdfs_path, os.path.basename(part_dir))
+
+        def upload_one(part_file):
+            hdfs_file = '%s/%s' % (tmp_path, os.path.basename(part_file))
+            self.conn.upload(hdfs_file, part_file, overwrite=True)
+            if verify:
+                self._verify_upload(hdfs_file, part_file, verify)
+            os.remove(part_file)  # 上传成功就删除，不占本地磁盘
+            return hdfs_file
+
+        try:
+            # 一边合并，一边上传，等待上传的数据块太多时，先等最早的上传完再继续合并
+            tmp_files = []
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=n_threads) as pool:
+                for part_file in self._pack_parts(source, part_dir, target_size, compress, skip_header, sep, header):
+                    if len(pending) >= n_threads * 2:
+                        tmp_files.append(pending.popleft().result())
+                    pending.append(pool.submit(upload_one, part_file))
+                while pending:
+                    tmp_files.append(pending.popleft().result())
+            # 全部上传成功，替换原来的数据块
+            for file in old_parts:
+                self.conn.delete('%s/%s' % (hdfs_path, file))
+            all_hdfs_files = []
+            for tmp_file in tmp_files:
+                hdfs_file = '%s/%s' % (hdfs_path, tmp_file.split('/')[-1])
+                self.conn.rename(tmp_file, hdfs_file)
+                all_hdfs_files.append(hdfs_file)
+        finally:
+            shutil.rmtree(part_dir, ignore_errors=True)
+            try:
+                self.conn.delete(tmp_path, recursive=True)
+            except Exception:
+                pass
+        t2 = time.time()
+        self.to_log('上传 %d 个数据块到：%s，耗时：%.2f 秒' % (len(all_hdfs_files), hdfs_path, t2 - t1), log)
+        return all_hdfs_files
+
     def makedirs(self, *args, **kwargs):
         """创建目录"""
         return self.conn.makedirs(*args, **kwargs)
@@ -137,18 +402,27 @@ class pyhdfs():
         print('获取HIVE表 %s 字段名：%s' % (tb_name, str(columns)))
         return columns
 
-    def download(self, hdfs_path, local_path, overwrite=True, n_threads=1):
+    @property
+    def cache(self):
+        """本地缓存，第一次用到时才创建目录"""
+        if self._cache is None:
+            self._cache = hdfs_cache(self._cache_dir, self._cache_max_bytes)
+        return self._cache
+
+    def download(self, hdfs_path, local_path, overwrite=True, n_threads=1, use_cache=False):
         """
         从hdfs下载数据,如果本地已存在该文件夹，则删除改文件夹
         :param hdfs_path: hdfs的文件路径
         :param local_path: 存放的本地路径，是一个文件夹
         :param overwrite: Overwrite any existing file or directory.
         :param n_threads: 开启多线程下载，当数据很多的时候可以使用
+        :param use_cache: 使用本地缓存，只下载有变化的文件，没有变化的文件直接从缓存硬链接过来。
+                          缓存会一直占用本地磁盘（最多 cache_max_bytes），只有一天内反复下载的表才需要打开
         :return:
         """
         # 查看远程路径是否存在
         try:
-            self.conn.status(hdfs_path)
+            status = self.conn.status(hdfs_path)
         except Exception as e:
             raise Exception('hdfs上没有这个东西：%s，请检查' % hdfs_path)
         # 查看本地路径是否存在，如果存在则删除
@@ -156,15 +430,51 @@ class pyhdfs():
             self.to_log('本地目录已经存在，将删除：' + local_path)
             shutil.rmtree(local_path)
         # 开始下载
-        self.conn.download(hdfs_path, local_path, overwrite=overwrite, n_threads=n_threads)
-        self.to_log('文件已经下载到：' + local_path)
+        if not use_cache:
+            self.conn.download(hdfs_path, local_path, overwrite=overwrite, n_threads=n_threads)
+            self.to_log('文件已经下载到：' + local_path)
+            return
+        # 使用缓存：每个文件对应的本地路径
+        if status['type'] == 'FILE':
+            all_files = [(hdfs_path, status, local_path)]
+        else:
+            all_files = []
+            for path, dirs, files in self.conn.walk(hdfs_path, status=True):
+                sub_path = os.path.relpath(path[0], hdfs_path)
+                for file, file_status in files:
+                    all_files.append(('%s/%s' % (path[0], file), file_status,
+                                      os.path.normpath(os.path.join(local_path, sub_path, file))))
+
+        def fetch(args):
+            hdfs_file, file_status, local_file = args
+            hit = os.path.exists(self.cache.cache_file(hdfs_file, file_status))
+            local_dir = os.path.dirname(local_file)
+            if local_dir and not os.path.exists(local_dir):
+                os.makedirs(local_dir, exist_ok=True)
 
-    def load_csv_from_hdfs(self, hdfs_path, local_path, file_name, log=None):
+            def link(cache_file):
+                # 硬链接不占空间，跨磁盘不能硬链接时复制
+                try:
+                    os.link(cache_file, local_file)
+                except FileNotFoundError:
+                    raise
+                except OSError:
+                    shutil.copyfile(cache_file, local_file)
+
+            self.cache.use(self.conn, hdfs_file, file_status, link)
+            return hit
+
+        with ThreadPoolExecutor(max_workers=max(n_threads, 1)) as pool:
+            hits = list(pool.map(fetch, all_files))
+        self.to_log('文件已经下载到：%s，共 %d 个文件，其中 %d 个来自本地缓存' % (local_path, len(hits), sum(hits)))
+
+    def load_csv_from_hdfs(self, hdfs_path, local_path, file_name, log=None, use_cache=False):
         """
         从hdfs下载数据, 需要注意的是，一般我们用到这个函数的时候，是下载csv类型的文件。
         下载下来的是一堆小文件，需要合并成一个大文件，因此需要指定分隔符。
         :param hdfs_path:
         :param local_path:
+        :param use_cache: 使用本地缓存，没有变化的文件不重新下载
         :return:
         步骤：
         1.下载数据到本地临时文件夹
@@ -184,7 +494,7 @@ class pyhdfs():
         self.to_log(info, log)
         # 下载数据
         files_dir_path = os.path.join(local_path, file_name) + '_tmp_dir'
-        self.download(hdfs_path, files_dir_path)
+        self.download(hdfs_path, files_dir_path, use_cache=use_cache)
         # 合并数据
         files = [file for file in os.listdir(files_dir_path) if file.endswith('.csv')]
         files = [os.path.join(files_dir_path, file) for file in files]
@@ -208,88 +518,289 @@ class pyhdfs():
         # 返回下载后的文件名
         return file_path2
 
-    def read_csv_from_hdfs(self, hdfs_path, local_path=None, header=None, log=None, text_end=False):
+    def list_data_files(self, hdfs_path, text_end=False, status=False):
+        """
+        列出hdfs目录（包括子目录，比如hive分区）下面的所有数据文件，排除 _SUCCESS 等标记文件.
+        :param text_end: 仅保留txt或csv结尾的数据文件
+        :param status: 为True时返回 [(文件, 文件status), ...]，status里面有文件大小和修改时间
+        """
+        # 检查是否存在
+        try:
+            dir_status = self.conn.status(hdfs_path)
+        except:
+            raise Exception('hdfs上没有这个目录，请检查：' + hdfs_path)
+        # 检查传进来的是文件名还是路径名
+        if dir_status['type'] == 'FILE':
+            raise Exception('传进来的是文件名称，不是hdfs路径，请检查：' + hdfs_path)
+        # 循环读取数据,之所以用循环，特别是hive表可能是分区表的时候很麻烦
+        # 这里千万注意，一定要是linux的目录分隔符格式，即/，而不是\\
+        all_files = []
+        for path, partition, files in self.conn.walk(hdfs_path, status=True):
+            all_files.extend([('%s/%s' % (path[0], file), file_status) for file, file_status in files
+                              if '_SUCCESS' not in file])
+        # 筛选要求csv或txt结尾
+        if text_end:
+            all_files = [(file, file_status) for file, file_status in all_files
+                         if file.lower().endswith('txt') or file.lower().endswith('csv')]
+        if status:
+            return all_files
+        return [file for file, file_status in all_files]
+
+    def _read_csv_file(self, file, header=None, sep=',', dtype=None, status=None):
+        """
+        读取一个hdfs数据文件，直接从字节流解析成dataframe，空文件返回None.
+        如果传入文件的status，则通过本地缓存读取
+        """
+        def parse(source):
+            # 没有传入表头，则第一行是表头
+            if header:
+                return pd.read_csv(source, sep=sep, header=None, names=header, dtype=dtype)
+            return pd.read_csv(source, sep=sep, dtype=dtype)
+
+        if status is not None:
+            if status['length'] == 0:
+                return None
+            return self.cache.use(self.conn, file, status, parse)
+        with self.conn.read(file) as reader:
+            content = reader.read()
+        if len(content.strip()) == 0:
+            return None
+        return parse(io.BytesIO(content))
+
+    def read_csv_from_hdfs(self, hdfs_path, local_path=None, header=None, log=None, text_end=False,
+                           sep=',', dtype=None, n_threads=8, use_cache=False):
         """
         从hdfs上面直接下载数据，一般是下载一个文件夹，然后将文件夹里面的数据文件整合成一个大的dataframe。
         和 load_csv_from_hdfs 函数不同的是，read是直接读取hdfs文件数据，然后在内存中转成dataframe
         load是现将数据文件保存到本地，然后再读取到python，整合成一个大的dataframe，再写到文件，来回倒腾。
+        多个线程同时读取各个数据文件，每个文件的字节流直接交给 pandas.read_csv 解析，不经过本地磁盘。
         :param hdfs_path: hdfs路径
         :param local_path: 如果指定，则保存到本地，Nne则返回dataframe给其他模块
         :param header: 如果csv是没有表头的，则需要传入表头,list类型，header=['a','b','c',...]
         :param log:
         :param text_end: 仅能识别txt或csv结尾的数据文件
+        :param sep: 分隔符，hive默认的分隔符是 '\001'
+        :param dtype: 字段类型，dict类型，dtype={'a': str, 'b': 'float64'}，不指定则由 read_csv 推断。
+                      各个文件推断出来的类型可能不一致（比如某个文件全是整数），有字符串id等字段时最好指定
+        :param n_threads: 同时读取的文件数
+        :param use_cache: 通过本地缓存读取，没有变化的文件直接读本地缓存，适合一天内反复读取的表
         :return:
         dataframe.repartition(1).write.mode("overwrite").options(header="true").csv("/home/xx.csv")
         """
         self.ping()
         print('-' * 100)
-        t1 = time.clock()
-        conn = self.conn
-        # 检查是否存在
-        if not conn.status(hdfs_path):
-            raise Exception('hdfs上没有这个目录，请检查：' + hdfs_path)
-        # 检查传进来的是文件名还是路径名
-        status = conn.status(hdfs_path)
-        if status['type'] == 'FILE':
-            raise Exception('传进来的是文件名称，不是hdfs路径，请检查：' + hdfs_path)
-        # 循环读取数据,之所以用循环，特别是hive表可能是分区表的时候很麻烦
-        # 这里千万注意，一定要是linux的目录分隔符格式，即/，而不是\\
-        all_files = list(conn.walk(hdfs_path))
-        all_files2 = []
-        for path, partition, files in all_files:
-            files2 = ['%s/%s'%(path, file) for file in files if '_SUCCESS' not in file]
-            all_files2.extend(files2)
-        # 筛选要求csv或txt结尾
-        if text_end==True:
-            all_files2 = [file for file in all_files2
-                        if file.lower().endswith('txt') or file.lower().endswith('csv')]
-        print('hdfs：%s 下一共有%d个文件是txt或者csv' % (hdfs_path, len(all_files2)))
+        t1 = time.time()
+        all_files = self.list_data_files(hdfs_path, text_end=text_end, status=True)
+        print('hdfs：%s 下一共有%d个数据文件' % (hdfs_path, len(all_files)))
         # 读取数据
         if not header:
             print('没有传入字段名，将使用第一行作为dataframe的字段名')
-        all_data = []
-        for file in all_files2:
-            # 直接读取数据，是byte类型
-            with conn.read(file) as reader:
-                data = [row.split(',') for row in reader.read().decode().split('\n') if row]  # 排除空行
-            if len(data)==0:
-                print('hdfs分区文件(%s)没有数据，继续读取下一个'%file)
-                continue
-            # 转成dataframe
-            if header:
-                data2 = pd.DataFrame(data, columns=header)
-            else:
-                data2 = pd.DataFrame(data[1:], columns=data[0])  # 默认第一行的表头，2-n行是数据
-            all_data.append(data2)
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            all_data = list(pool.map(lambda args: self._read_csv_file(args[0], header, sep, dtype,
+                                                                      args[1] if use_cache else None), all_files))
+        all_files = [file for file, status in all_files]
+        for file, data in zip(all_files, all_data):
+            if data is None:
+                print('hdfs分区文件(%s)没有数据' % file)
+        all_data = [data for data in all_data if data is not None]
+        if len(all_data) == 0:
+            raise Exception('hdfs：%s 下面没有数据' % hdfs_path)
         # 将所有数据子集合并成一个大的dataframe
-        all_data2 = pd.concat(all_data)
-        t2 = time.clock()
+        all_data2 = pd.concat(all_data, ignore_index=True)
+        t2 = time.time()
         print('下载并将所有子文件合并成一个大的dataframe，数据量：%d，耗时：%d 秒' % (len(all_data2), t2 - t1))
         # 是否返回，如果传入保存路径则保存到数据文件，否则就直接返回dataframe
-        if not local_path:
-            tmp_file_path = os.path.join(ex_data,'_read_csv_from_hdfs_%s.csv'%datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
-        else:
-            tmp_file_path = local_path
-        p_path = os.path.dirname(tmp_file_path)
-        if not os.path.exists(p_path):
-            print('目录：%s 不存在，将创建' % p_path)
-            os.makedirs(p_path)
-        all_data2.to_csv(tmp_file_path, index=False)
-        print('数据保存到本地文件：' + tmp_file_path)
-        print('-' * 100)
         if local_path:
+            p_path = os.path.dirname(local_path)
+            if p_path and not os.path.exists(p_path):
+                print('目录：%s 不存在，将创建' % p_path)
+                os.makedirs(p_path)
+            all_data2.to_csv(local_path, index=False)
+            print('数据保存到本地文件：' + local_path)
+            print('-' * 100)
             return local_path
+        print('-' * 100)
+        return all_data2
+
+    def _iter_csv_file(self, file, header=None, sep=',', dtype=None, chunk_size=64 * 1024 * 1024):
+        """
+        流式读取一个hdfs数据文件，每次从webhdfs读取 chunk_size 字节，解析成dataframe后返回（生成器）.
+        一行数据可能被切在两个chunk之间，所以每次只解析到最后一个换行符，剩下的半行留到下一个chunk。
+        """
+        columns = header
+        remainder = b''
+        with self.conn.read(file, chunk_size=chunk_size) as reader:
+            for chunk in reader:
+                buffer = remainder + chunk
+                end = buffer.rfind(b'\n')
+                # 这个chunk里面还没有一整行
+                if end < 0:
+                    remainder = buffer
+                    continue
+                remainder = buffer[end + 1:]
+                buffer = buffer[:end + 1]
+                # 没有传入表头，则文件的第一行是表头
+                if columns is None:
+                    first_end = buffer.find(b'\n')
+                    columns = buffer[:first_end].decode().rstrip('\r').split(sep)
+                    buffer = buffer[first_end + 1:]
+                if len(buffer.strip()) > 0:
+                    yield pd.read_csv(io.BytesIO(buffer), sep=sep, header=None, names=columns, dtype=dtype)
+        # 最后一行可能没有换行符
+        if len(remainder.strip()) > 0 and columns is not None:
+            yield pd.read_csv(io.BytesIO(remainder), sep=sep, header=None, names=columns, dtype=dtype)
+
+    def iter_csv_from_hdfs(self, hdfs_path, header=None, text_end=False, sep=',', dtype=None,
+                           chunk_size=64 * 1024 * 1024):
+        """
+        流式读取hdfs目录下的数据，按批次返回dataframe（生成器），用于处理不能一次性读到内存里的大文件.
+        read_csv_from_hdfs 会把每个数据文件整个读到内存，一个几G的文件在内存里有bytes、str、list三份拷贝；
+        这里每次只读 chunk_size 字节，内存占用只和 chunk_size 有关，和文件大小无关。
+        注意，字符串字段里不能有换行符，否则行会被切错.
+        :param hdfs_path: hdfs路径
+        :param header: 如果csv是没有表头的，则需要传入表头,list类型，header=['a','b','c',...]
+        :param text_end: 仅能识别txt或csv结尾的数据文件
+        :param sep: 分隔符
+        :param dtype: 字段类型，dict类型。每个批次是单独推断类型的，最好指定，否则不同批次的类型可能不一致
+        :param chunk_size: 每次从hdfs读取的字节数，也就是每个批次的大小
+        :return:
+        for df in conn.iter_csv_from_hdfs('/apps/hive/warehouse/tmp.db/tmp', header=['a', 'b'], sep='\001'):
+            do_something(df)
+        """
+        self.ping()
+        all_files = self.list_data_files(hdfs_path, text_end=text_end)
+        print('hdfs：%s 下一共有%d个数据文件' % (hdfs_path, len(all_files)))
+        for file in all_files:
+            for df in self._iter_csv_file(file, header=header, sep=sep, dtype=dtype, chunk_size=chunk_size):
+                yield df
+
+    @staticmethod
+    def _file_column_map(file_names, table_columns):
+        """
+        数据文件里的字段名 -> hive元数据的字段名（小写）。
+        元数据的字段名都是小写，parquet文件里的字段名可能有大写，按不区分大小写对应；
+        老版本hive写的orc文件，字段名是 _col0, _col1, ...，只能按位置对应
+        """
+        if table_columns and file_names and all([re.match(r'^_col\d+$', name) for name in file_names]):
+            return dict(zip(file_names, table_columns))
+        return dict([(name, name.lower()) for name in file_names])
+
+    def _read_columnar_file(self, hdfs_file, length, file_format, columns=None, table_columns=None):
+        """
+        读取一个orc或者parquet文件，只读取需要的列，返回的字段名是hive元数据的字段名
+        :param columns: 需要的字段，hive元数据的字段名，None表示全部；文件里没有的字段（表后来新增的字段）跳过
+        :param table_columns: hive元数据里的非分区字段，按顺序，用于对应文件里的字段名
+        """
+        f = io.BufferedReader(webhdfs_file(self.conn, hdfs_file, length), buffer_size=4 * 1024 * 1024)
+        try:
+            if file_format == 'parquet':
+                import pyarrow.parquet as pq
+                reader = pq.ParquetFile(f)
+                file_names = reader.schema_arrow.names
+            else:
+                import pyarrow.orc as orc
+                reader = orc.ORCFile(f)
+                file_names = reader.schema.names
+            name_map = self._file_column_map(file_names, table_columns)
+            file_columns = None
+            if columns is not None:
+                table_to_file = dict([(v, k) for k, v in name_map.items()])
+                file_columns = [table_to_file[col] for col in columns if col in table_to_file]
+            if file_columns == []:
+                # 只要分区字段（或者文件里没有要的字段）时，orc读空的字段列表会返回0行，直接用元数据里的行数
+                num_rows = reader.metadata.num_rows if file_format == 'parquet' else reader.nrows
+                df = pd.DataFrame(index=pd.RangeIndex(num_rows))
+            else:
+                df = reader.read(columns=file_columns).to_pandas()
+        finally:
+            f.close()
+        df.columns = [name_map.get(col, col.lower()) for col in df.columns]
+        return df
+
+    def read_hive_table(self, ai_hive, hive_table, columns=None, partition_filter=None, n_threads=8):
+        """
+        不通过hiveserver2，直接从hdfs读取orc或者parquet格式的hive表.
+        表的hdfs路径、存储格式、分区都从hive的元数据获取（pyhive.describe_table, pyhive.show_partitions），
+        字段裁剪交给pyarrow（只读取需要的列），分区裁剪在列出文件之前完成（只读取需要的分区目录）。
+        需要安装 pyarrow。text格式的表请使用 read_hive_data_from_hdfs
+        :param ai_hive: pyhive连接
+        :param hive_table: hive表名，db.tb_name
+        :param columns: 需要的字段，list，None表示全部字段；分区字段也可以放在这里
+        :param partition_filter: 分区过滤条件，dict，值可以是单个值、list，或者函数
+                    partition_filter={'dd': ['2018-10-10', '2018-10-11'], 'store': lambda v: v in ('1', '2')}
+        :param n_threads: 同时读取的文件数
+        :return: dataframe，分区字段作为字符串字段加在后面
+        """
+        self.ping()
+        t1 = time.time()
+        info = ai_hive.describe_table(hive_table)
+        input_format = info['input_format'].lower()
+        if 'parquet' in input_format:
+            file_format = 'parquet'
+        elif 'orc' in input_format:
+            file_format = 'orc'
         else:
-            # 如果直接返回dataframe，数据格式都是字符串，要保存到csv再读取才是正确的格式
-            # 从csv再次读取
-            all_data2 = pd.read_csv(tmp_file_path)
-            # 删除文件
-            os.remove(tmp_file_path)
-            print('删除本地文件：' + tmp_file_path)
-            print('-' * 100)
-            return all_data2
+            raise Exception('表 %s 的存储格式是 %s，只支持orc和parquet，text表请使用 read_hive_data_from_hdfs'
+                            % (hive_table, info['input_format']))
+        location = urlparse(info['location']).path
+        partition_col = info['partition_col']
+        # 字段裁剪，分区字段不在数据文件里；文件里的字段名可能是大写或者 _col0，读取时再对应到元数据的字段名
+        file_columns = None
+        if columns:
+            columns = [col.lower() for col in columns]
+            unknown = [col for col in columns if col not in info['columns'] + partition_col]
+            if unknown:
+                raise Exception('表 %s 没有这些字段：%s' % (hive_table, str(unknown)))
+            file_columns = [col for col in columns if col not in partition_col]
+        # 分区裁剪
+        partition_filter = partition_filter if partition_filter else {}
+        if partition_col:
+            all_dirs = []
+            for spec in ai_hive.show_partitions(hive_table):
+                values = dict([(k, unquote(v)) for k, v in [kv.split('=', 1) for kv in spec.split('/')]])
+                keep = True
+                for col, condition in partition_filter.items():
+                    value = values.get(col)
+                    if callable(condition):
+                        keep = keep and condition(value)
+                    elif isinstance(condition, (list, tuple, set)):
+                        keep = keep and value in [str(v) for v in condition]
+                    else:
+                        keep = keep and value == str(condition)
+                if keep:
+                    all_dirs.append(('%s/%s' % (location, spec), values))
+            print('表 %s 共有分区字段 %s，分区裁剪后需要读取 %d 个分区' % (hive_table, str(partition_col), len(all_dirs)))
+        else:
+            all_dirs = [(location, {})]
+        # 列出需要读取的文件
+        all_files = []
+        for path, values in all_dirs:
+            for file, status in self.list_data_files(path, status=True):
+                if status['length'] > 0 and not os.path.basename(file).startswith(('.', '_')):
+                    all_files.append((file, status['length'], values))
+        print('表 %s 一共需要读取 %d 个%s文件' % (hive_table, len(all_files), file_format))
+
+        def read_one(args):
+            file, length, values = args
+            df = self._read_columnar_file(file, length, file_format, file_columns, info['columns'])
+            for col, value in values.items():
+                df[col] = value
+            return df
 
-    def read_hive_data_from_hdfs(self, hive_table, header=None, local_path=None):
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            all_data = list(pool.map(read_one, all_files))
+        if len(all_data) == 0:
+            data = pd.DataFrame(columns=columns if columns else info['columns'] + partition_col)
+        else:
+            data = pd.concat(all_data, ignore_index=True)
+            if columns:
+                # 表后来新增的字段，老文件里没有，和hive一样读成空值
+                data = data.reindex(columns=columns)
+        t2 = time.time()
+        print('从hdfs读取hive表 %s，数据量：%d，耗时：%.2f 秒' % (hive_table, len(data), t2 - t1))
+        return data
+
+    def read_hive_data_from_hdfs(self, hive_table, header=None, local_path=None, sep=',', dtype=None, use_cache=False):
         """
         从hdfs读取hive数据，而不是通过hive session，注意，只能读取存储为text类型的hive表
         原理和read_csv_from_hdfs是一样的，只不过在外部修改hdfs路径为hive路径唯一.
@@ -297,7 +808,9 @@ class pyhdfs():
         :param header: 如果csv是没有表头的，则需要传入表头,list类型，header=['a','b','c',...]
                         一般来说，hive表的hdfsfile都是没有表头的.
         :param local_path: 如果指定，则保存到本地，Nne则返回给其他模块
-        :param log:
+        :param sep: hive表的字段分隔符
+        :param dtype: 字段类型，参见 read_csv_from_hdfs
+        :param use_cache: 使用本地缓存，没有变化的文件不重新下载
         :return:
         """
         self.ping()
@@ -306,7 +819,8 @@ class pyhdfs():
             raise Exception('你应该传入hive表头')
         hdfs_path = '/apps/hive/warehouse/{db_name}.db/{tb_name}'.format(
             db_name=hive_table.split('.')[0],tb_name=hive_table.split('.')[-1])
-        all_data2 = self.read_csv_from_hdfs(self, hdfs_path=hdfs_path, header=header, text_end=False)
+        all_data2 = self.read_csv_from_hdfs(hdfs_path=hdfs_path, header=header, text_end=False, sep=sep,
+                                            dtype=dtype, use_cache=use_cache)
         # 是否返回
         if local_path:
             all_data2.to_csv(local_path, index=False)
@@ -329,6 +843,14 @@ def test():
                             file_name='s.csv')
     # 从hdfs读取文件到本地，而不是下载到本地后再读取整合
     data = conn.read_csv_from_hdfs(hdfs_path='/apps/hive/warehouse/g')
+    # 列出目录下的数据文件，不传status时返回的是文件名，传status=True时才是 (文件名, status)
+    files = conn.list_data_files('/apps/hive/warehouse/tmp.db/tmp')
+    assert all([isinstance(file, str) for file in files])
+    files = conn.list_data_files('/apps/hive/warehouse/tmp.db/tmp', status=True)
+    assert all([isinstance(file, tuple) for file in files])
+    # 流式读取，最后一行没有换行符的文件也要读全
+    for df in conn.iter_csv_from_hdfs('/apps/hive/warehouse/tmp.db/tmp', chunk_size=1024 * 1024):
+        print(len(df))
     # 上传文件
     conn.list('/apps/hive/warehouse/tmp.db/tmp')
     conn.conn.delete('/apps/hive/warehouse/tmp.db/tmp.csv')
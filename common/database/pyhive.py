@@ -174,6 +174,43 @@ class pyhive():
         print('数据量%d' % len(data))
         return data
 
+    def read_table_chunks(self, tb_name=None, sql=None, queue='ai', chunk_size=200000):
+        """
+        和 read_table 一样读取hive数据，但不是一次性组装成一个大的dataframe，而是每次取 chunk_size 条，
+        以dataframe的形式逐批返回（生成器）。适合千万级的表，内存只和 chunk_size 有关。
+        """
+        if not sql:
+            data_sql = "select * from {tb_name}".format(tb_name=tb_name)
+        else:
+            data_sql = sql
+        # 先执行队列配置
+        queue_sql = "set mapreduce.job.queuename={queue}".format(queue=queue)
+        cur = self.conn.cursor()
+        cur.execute(queue_sql)
+        self.conn.commit()
+        # 先取出表头
+        if ' limit ' in data_sql.lower():
+            tmp_data_sql = data_sql
+        else:
+            tmp_data_sql = data_sql + ' limit 1 '
+        columns_df = pd.read_sql(tmp_data_sql, self.conn)
+        columns = [col.lower().split('.')[-1] for col in columns_df.columns]
+        print('获取的字段名是：' + ', '.join(columns))
+        # 开始逐批取数据
+        try:
+            cur.execute(data_sql)
+            cnt = 0
+            while True:
+                sub_data = cur.fetchmany(chunk_size)
+                if len(sub_data) == 0:
+                    break
+                cnt += len(sub_data)
+                print('%s 取数- %dw-%dw' % (str(datetime.datetime.now())[:19], (cnt - len(sub_data)) / 10000,
+                                          cnt / 10000))
+                yield pd.DataFrame(list(sub_data), columns=columns)
+        finally:
+            cur.close()
+
     def read_table_using_hive_e(self, tb_name=None, sql=None, sep=',', local_path=None):
         """
         使用hive -e的方式从hive下载数据.
@@ -454,6 +491,37 @@ class pyhive():
             self.to_log('存储过程执行失败，请跟进', log)
             return 0
 
+    def describe_table(self, tb_name):
+        """
+        通过 describe formatted 获取表的存储信息，用于绕过hiveserver2直接读取hdfs上的数据文件.
+        :return: {'location': hdfs路径, 'input_format': 输入格式, 'columns': [非分区字段], 'partition_col': [分区字段]}
+        """
+        desc = pd.read_sql("describe formatted " + tb_name, self.conn).fillna('')
+        desc.columns = [col.lower().split('.')[-1] for col in desc.columns]
+        info = {'location': '', 'input_format': '', 'columns': [], 'partition_col': []}
+        section = 'columns'
+        for col_name, data_type in zip(desc['col_name'], desc['data_type']):
+            col_name, data_type = col_name.strip(), data_type.strip()
+            if col_name == '# Partition Information':
+                section = 'partition_col'
+            elif col_name.startswith('# Detailed Table Information'):
+                section = 'detail'
+            elif col_name == 'Location:':
+                info['location'] = data_type
+            elif col_name == 'InputFormat:':
+                info['input_format'] = data_type
+            elif section in ('columns', 'partition_col') and col_name and not col_name.startswith('#'):
+                if col_name not in info[section]:
+                    info[section].append(col_name.lower())
+        # 分区字段在前面的字段列表里也会出现一次
+        info['columns'] = [col for col in info['columns'] if col not in info['partition_col']]
+        return info
+
+    def show_partitions(self, tb_name):
+        """表的所有分区，返回 ['dd=2018-10-10/store=1', ...]，也就是分区在表目录下的子目录"""
+        partitions = pd.read_sql("show partitions " + tb_name, self.conn)
+        return partitions.iloc[:, 0].tolist()
+
     def create_new_partition(self, tb_name, partition_col, partition_value):
         """对表创建新的分区"""
         sql = """ alter table {tb_name} add partition({partition_col}='{partition_value}')""" \
@@ -472,11 +540,12 @@ class pyhive():
         self.conn.commit()
         cur.close()
 
-    def load_df_into_partition_table2(self, tb_name, df, partition_col=[], partition_value=[], local_path=None, sep=','):
+    def load_df_into_partition_table2(self, tb_name, df, partition_col=[], partition_value=[], local_path=None, sep=',',
+                                      overwrite=True):
         """
         上面的那个写复杂了，可以有更加简单的方法,用 load data 的方式
         你需要注意的是，df只能是一个分区的数据，因此partition_col的值都是一样的。
-        导入以覆盖分区方式导入。
+        默认以覆盖分区方式导入，overwrite=False 时追加到分区（增量备份时用到）。
 
         df=pd.DataFrame({'id':[1,2,3],'name':['name1','name2','name3'],'dd':['d2','d2','d2']})
         ai_hive.load_df_into_partition_table2(tb_name='tmp',df=df, partition_col='dd',
@@ -510,20 +579,21 @@ class pyhive():
         df.loc[:, cols].to_csv(local_file, index=False, header=None, sep=sep)  # 注意，不要保存表头，字段顺序要保持和表结构一致
         #
         # 导入分区的SQL
+        mode = 'overwrite' if overwrite else ''
         # 普通的导入
         if len(partition_col) == 0:
-            load_hive_sql = """hive -e "load data local inpath '{local_file}' overwrite into table {tb_name}
-                    " """.format(local_file=local_file, tb_name=tb_name)
+            load_hive_sql = """hive -e "load data local inpath '{local_file}' {mode} into table {tb_name}
+                    " """.format(local_file=local_file, tb_name=tb_name, mode=mode)
         # 只有一个分区字段的导入
         if len(partition_col) == 1:
-            load_hive_sql = """hive -e "load data local inpath '{local_file}' overwrite into table {tb_name} 
-                    partition({partition} = '{value}')" """.format(local_file=local_file, tb_name=tb_name,
+            load_hive_sql = """hive -e "load data local inpath '{local_file}' {mode} into table {tb_name} 
+                    partition({partition} = '{value}')" """.format(local_file=local_file, tb_name=tb_name, mode=mode,
                                                                    partition=partition_col[0], value=partition_value[0])
         # 有2个分区字段的导入
         if len(partition_col) == 2:
-            load_hive_sql = """hive -e "load data local inpath '{local_file}' overwrite into table {tb_name} 
+            load_hive_sql = """hive -e "load data local inpath '{local_file}' {mode} into table {tb_name} 
                             partition({partition1} = '{value1}', {partition2} = '{value2}')" """.format(
-                local_file=local_file, tb_name=tb_name, partition1=partition_col[0], value1=partition_value[0],
+                local_file=local_file, tb_name=tb_name, mode=mode, partition1=partition_col[0], value1=partition_value[0],
                 partition2=partition_col[1], value2=partition_value[1])
         # 指定导入语句
         print('%s\n%s\n%s'%('-'*200, load_hive_sql, '-'*200))
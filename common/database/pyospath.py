@@ -6,6 +6,7 @@ import shutil
 import platform
 import pickle
 import json
+from .pyfile import dump_pickle, load_pickle, default_codec
 
 
 
@@ -81,8 +82,11 @@ def remove_path_and_files(path):
 
 
 
-def pickle_file(path, io='read', data=None, overwrite=False):
-    """读写pickle文件"""
+def pickle_file(path, io='read', data=None, overwrite=False, compress=None, n_threads=4):
+    """
+    读写pickle文件
+    compress: 写的时候是否压缩，None 不压缩，lz4、zstd、zlib、default 参见 pyfile.dump_pickle，读的时候自动识别
+    """
     # data = {'a':123,'b':'a'}
     # path=r'D:\a\aa\a123'
     # force_write=True
@@ -91,7 +95,7 @@ def pickle_file(path, io='read', data=None, overwrite=False):
         if not os.path.exists(path):
             raise Exception('找不到文件：'+path)
         with open(path,'rb') as f:
-            data = pickle.load(f)
+            data = load_pickle(f, n_threads)
             return data
     # 写pickle文件 io='write'
     if io=='write':
@@ -111,7 +115,10 @@ def pickle_file(path, io='read', data=None, overwrite=False):
             print('目录不存在，已经创建：'+p_path)
         # 最后才是写
         with open(path, 'wb') as f:
-            pickle.dump(data, f, protocol=4)
+            if compress:
+                dump_pickle(data, f, default_codec() if compress == 'default' else compress, n_threads)
+            else:
+                pickle.dump(data, f, protocol=4)
 
 def json_file(path, io='read', data=None, overwrite=False):
     """读写pickle文件"""
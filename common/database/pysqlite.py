@@ -20,73 +20,130 @@ pd.read_sql(sql, conn)
 
 """
 
-import pandas as pd
+import os
+import threading
 import sqlite3
+from contextlib import contextmanager
 
 
 class pysqlite():
-    """用于作业状态存储，方便不同作业之间沟通信息，还是挺不错的"""
-
-    def __init__(self, db_file):
+    """
+    用于作业状态存储，方便不同作业之间沟通信息，还是挺不错的
+    多个作业进程同时读写时：
+    1、数据库用 WAL 模式，读不阻塞写，写也不阻塞读，只有写和写之间排队
+    2、每个线程缓存一个连接，不用每次执行SQL都重新连接
+    3、遇到锁时等待 timeout 秒（busy_timeout），而不是马上报 database is locked
+    4、批量更新用 update_params，在一个事务中写入，只加一次写锁
+    其他需要在sqlite中保存状态的模块（比如 mysql2hive.backup_state）也用这个类连接，连接和pragma的设置只在这里维护
+    """
+
+    def __init__(self, db_file, timeout=30, wal=True):
+        """
+        :param db_file: 数据库文件
+        :param timeout: 等待写锁的秒数
+        :param wal: 是否用 WAL 模式，数据库文件在网络盘（NFS等）上时不能用 WAL
+        """
         self._db = db_file
-        # self.conn = self.connect()
+        self._timeout = timeout
+        self._wal = wal
+        self._local = threading.local()  # 每个线程自己的连接
+        self._upsert_tables = set()  # 已经确认 pkey 有唯一索引的表
 
     def connect(self):
-        """连接数据库"""
-        return sqlite3.connect(self._db)
-
-    def execute(self, sql):
-        """执行SQL"""
+        """连接数据库，同一个线程复用一个连接；fork出来的子进程不能用父进程的连接，重新连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        # isolation_level=None：自动提交，需要事务时显式 begin
+        conn = sqlite3.connect(self._db, timeout=self._timeout, isolation_level=None)
+        if self._wal:
+            conn.execute('pragma journal_mode = wal')  # 写在数据库文件里，以后的连接都是 WAL 模式
+            conn.execute('pragma synchronous = normal')  # WAL 模式下 normal 不会损坏数据库，只是断电时可能丢最后的事务
+        conn.execute('pragma busy_timeout = %d' % (self._timeout * 1000))
+        conn.execute('pragma temp_store = memory')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """关闭当前线程缓存的连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+    def execute(self, sql, params=()):
+        """执行SQL，params 是SQL中 ? 对应的参数"""
+        self.connect().execute(sql, params)
+
+    def query(self, sql, params=()):
+        """查询，返回所有行的list"""
+        return self.connect().execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """
+        写事务，with 中的SQL一起提交，出错时回滚：
+            with db.transaction() as conn:
+                conn.execute(sql1, params1)
+                conn.execute(sql2, params2)
+        一开始就拿写锁（begin immediate），避免读锁升级写锁时和其他进程死锁
+        """
         conn = self.connect()
-        conn.execute(sql)
-        conn.commit()
-        conn.close()
+        conn.execute('begin immediate')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('rollback')
+            raise
+        conn.execute('commit')
 
     def create_params_table(self, tb_name='params_server'):
-        """创建参数状态表"""
+        """创建参数状态表，pkey 加唯一索引（update_params 的 upsert 需要），旧表中重复的 pkey 只保留最后一条"""
         conn = self.connect()
-        try:
-            pd.read_sql('select * from %s' % tb_name, conn)
-            conn.close()
-            return
-        except:
+        exists = conn.execute("select 1 from sqlite_master where type='table' and name=?", (tb_name,)).fetchone()
+        if not exists:
             print('参数状态表不存在，将创建：%s' % tb_name)
-        # 建表
-        create_sql = " create table params_server (pkey string, pvalue string) "
-        self.execute(create_sql)
+            conn.execute('create table if not exists %s (pkey string, pvalue string)' % tb_name)
+        with self.transaction() as conn:
+            conn.execute('delete from %s where rowid not in (select max(rowid) from %s group by pkey)'
+                         % (tb_name, tb_name))
+            conn.execute('create unique index if not exists %s_pkey on %s (pkey)' % (tb_name, tb_name))
+        self._upsert_tables.add(tb_name)
 
     def get_param(self, pkey='', pvalue=None, tb_name='params_server'):
         """模仿pymysql的状态表信息获取"""
         pkey = str(pkey).lower().strip()
-        conn = self.connect()
-        sql = """select pvalue from %s where pkey='%s' """ % (tb_name, pkey)
-        df = pd.read_sql(sql, conn)
-        conn.close()
-        if len(df) == 0:
+        sql = 'select pvalue from %s where pkey=?' % tb_name
+        row = self.connect().execute(sql, (pkey,)).fetchone()
+        if row is None:
             print('指定的参数 %s 不存在' % pkey)
             return None
         else:
-            return df['pvalue'].iat[0]
+            return row[0]
 
     def update_param(self, pkey='', pvalue='', tb_name='params_server'):
         """将指定参数更新到状态表"""
-        pkey = str(pkey).lower().strip()
-        pvalue = str(pvalue).lower().strip()
-        # 先判断参数是否存在
-        params = self.get_param(pkey)
-        if params:
-            sql = "update %s set %s = '%s' " % (tb_name, pkey, pvalue)
-        else:
-            sql = "insert into %s (pkey, pvalue) values ('%s', '%s')" % (tb_name, pkey, pvalue)
-        print(sql)
-        self.execute(sql)
+        self.update_params({pkey: pvalue}, tb_name=tb_name)
+
+    def update_params(self, params, tb_name='params_server'):
+        """
+        批量更新参数到状态表，params={pkey: pvalue}，不存在的插入，存在的更新。
+        所有参数在一个事务中写入，只加一次写锁、提交一次
+        """
+        if tb_name not in self._upsert_tables:
+            self.create_params_table(tb_name)
+        rows = [(str(k).lower().strip(), str(v).lower().strip()) for k, v in params.items()]
+        sql = ('insert into %s (pkey, pvalue) values (?, ?) '
+               'on conflict(pkey) do update set pvalue=excluded.pvalue' % tb_name)
+        with self.transaction() as conn:
+            conn.executemany(sql, rows)
 
     def clear_param(self, pkey='', tb_name='params_server'):
         """删除某个键"""
         pkey = str(pkey).lower().strip()
-        sql = "delete from %s where pkey='%s'" % (tb_name, pkey)
-        self.execute(sql)
-
+        sql = 'delete from %s where pkey=?' % tb_name
+        self.execute(sql, (pkey,))
 
 
 def _test():
@@ -102,6 +159,9 @@ def _test():
     # 更新参数
     ai_params.update_param(pkey='abc', pvalue='123')
 
+    # 批量更新参数，一个事务
+    ai_params.update_params({'abc': '456', 'job_a': 'done'})
+
     # 删除某个键
     ai_params.clear_param(pkey='abc')
 
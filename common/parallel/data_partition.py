@@ -4,78 +4,55 @@
 """
 
 import pandas as pd
+import numpy as np
 import os
 import pickle
+import heapq
 from numpy import linspace
 
 
-def file_partition(file, cnt_perfile, id_col, prefix):
+def file_partition(file, cnt_perfile=None, id_col=None, prefix='', par_cnt=10, chunksize=500000, sep=','):
     '''
     读取文件，并且将文件按照指定字段进行分割成小文件。用于大文件的分割，后边用于并行计算。
     每个对象有独立ID，每个对象有多行，但是某些字段值是不一样的，比如一个sku有多天的数据记录。
-    注意，默认file是在数据库中按照ID字段进行排序后的。
-    :param file: 数据文件
-    :param cnt_perfile:每个子文件的id数量
-    :param id_col: 分组依据，也就是每个对象的id
+    按id字段的哈希值把每一行分到 par_cnt 个子文件中的一个，相同的id一定在同一个子文件，不要求文件按id排序。
+    分块读取，每块向量化计算哈希后按子文件分组写出，所有子文件在整个过程中一直打开，不会每块都重新打开。
+    所有字段按字符串读取和写出，不做类型转换，哈希值只和字段的文本有关。
+    :param file: 数据文件，第一行是列名
+    :param cnt_perfile: 每个子文件的id数量(已废弃，用 par_cnt)
+    :param id_col: 分组依据，也就是每个对象的id，字符串或者list
     :param prefix: 保存子文件的前缀
-    :return:
+    :param par_cnt: 分割成多少个子文件
+    :param chunksize: 每次读取多少行
+    :param sep: 分隔符
+    :return: 子文件列表，没有数据的子文件会被删除
     '''
-    all_files = []
-    # 获取列名
-    with open(file, 'r') as f:
-        columns = f.readline()[:-1].split(',')
-    tmp_data = pd.DataFrame(columns=columns)
-    # 初始化
-    id_cnt = 0
-    file_id = 1
     file_path = os.path.split(file)[0]
-    subfile_name = os.path.join(file_path, prefix + '_%03d.csv' % file_id)
-    tmp_data.to_csv(subfile_name, index=False)  # 写入列名，后面追加写入时不需要写，否则文件没列名很难受的
-    all_files.append(subfile_name)
-    # 开始读取数据
-    reader = pd.read_csv(file, chunksize=10000)
-    for data in reader:
-        cnt = len(data[id_col].unique())  # 这批数据里面有多少id
-        id_cnt += cnt  # 累积了多少id
-        # 如果id数量还不够，直接写到文件
-        if id_cnt < cnt_perfile:
-            data.to_csv(subfile_name, index=False, header=None, mode='a')
-            continue
-        # 如果刚好够了，除了写到文件，还要创建下一个数据文件
-        if id_cnt == cnt_perfile:
-            data.to_csv(subfile_name, index=False, header=None, mode='a')
-            id_cnt = 0
-            file_id += 1
-            subfile_name = os.path.join(file_path, prefix + '_%03d.csv' % file_id)
-            tmp_data.to_csv(subfile_name, index=False)
-            all_files.append(subfile_name)
-            continue
-        # 如果超出了指定数量，那么就需要分割成两个子文件
-        else:
-            ids = []
-            for id in data[id_col]:
-                if id in ids:
-                    continue
-                else:
-                    ids.append(id)
-                if len(ids) + id_cnt < cnt_perfile:
-                    continue
-                else:
-                    break
-            # 取出属于前1个file的data
-            subdata = data.loc[data[id_col].isin(ids)]
-            subdata.to_csv(subfile_name, index=False, header=None, mode='a')
-            # 构造下一个file
-            id_cnt = 0
-            file_id += 1
-            subfile_name = os.path.join(file_path, prefix + '_%03d.csv' % file_id)
-            tmp_data.to_csv(subfile_name, index=False)
-            all_files.append(subfile_name)
-            # 剩余数据写到这里
-            subdata2 = data.loc[-data[id_col].isin(ids)]
-            subdata2.to_csv(subfile_name, index=False, header=None, mode='a')
-    # 返回
-    return all_files
+    all_files = [os.path.join(file_path, prefix + '_%03d.csv' % (i + 1)) for i in range(par_cnt)]
+    row_cnt = [0] * par_cnt
+    all_writer = []
+    try:
+        for subfile_name in all_files:
+            all_writer.append(open(subfile_name, 'w', buffering=1024 * 1024, newline=''))
+        reader = pd.read_csv(file, sep=sep, chunksize=chunksize, dtype=str, keep_default_na=False)
+        for i, data in enumerate(reader):
+            if i == 0:
+                # 写入列名，没有数据的子文件最后会被删除
+                header = sep.join(data.columns) + '\n'
+                for writer in all_writer:
+                    writer.write(header)
+            par_ids = hash_bucket(data, id_col, par_cnt)
+            for par_id, rows in _split_rows(par_ids, par_cnt):
+                data.iloc[rows].to_csv(all_writer[par_id], sep=sep, header=False, index=False)
+                row_cnt[par_id] += len(rows)
+    finally:
+        for writer in all_writer:
+            writer.close()
+    # 删除没有数据的子文件
+    for i in range(par_cnt):
+        if row_cnt[i] == 0:
+            os.remove(all_files[i])
+    return [all_files[i] for i in range(par_cnt) if row_cnt[i] > 0]
 
 
 def test():
@@ -88,10 +65,98 @@ def test():
     file = r"C:\Users\suzhenyu\Desktop\a.csv"
     data.to_csv(file, index=False)
     # 分割数据集
-    file_partition(file, cnt_perfile=4, id_col='id', prefix='test_split')
+    file_partition(file, id_col='id', prefix='test_split', par_cnt=4)
+
+
+def hash_bucket(df, id_col, n_bucket=1024):
+    """
+    对id字段做向量化的哈希，返回每一行的桶号（0 ~ n_bucket-1）。
+    用的是 pd.util.hash_pandas_object，结果只和取值有关，不受 PYTHONHASHSEED 影响，不同进程、不同次运行都一样。
+    多个id字段时，按行组合多个字段的哈希，不需要拼接字符串。
+    """
+    id_col = id_col if isinstance(id_col, list) else [id_col]
+    if len(id_col) == 1:
+        hash_value = pd.util.hash_pandas_object(df[id_col[0]], index=False).values
+    else:
+        hash_value = pd.util.hash_pandas_object(df[id_col], index=False).values
+    return (hash_value % np.uint64(n_bucket)).astype(np.int64)
+
+
+def balance_buckets(bucket, par_cnt, weight=None, n_bucket=1024):
+    """
+    把桶分配到 par_cnt 个分区，使每个分区的行数（或者权重之和）尽量接近。
+    先按桶统计行数/权重，从大到小依次放到当前最轻的分区（LPT贪心），返回 桶号->分区号 的数组。
+    :param bucket: 每一行的桶号，hash_bucket 的结果
+    :param par_cnt: 分区数量
+    :param weight: 每一行的权重，None 表示按行数均衡
+    :param n_bucket: 桶的数量
+    :return: 长度为 n_bucket 的数组，空桶的分区号是 -1
+    """
+    load = np.bincount(bucket, weights=weight, minlength=n_bucket)
+    not_empty = np.flatnonzero(np.bincount(bucket, minlength=n_bucket))
+    bucket_par = np.full(n_bucket, -1, dtype=np.int64)
+    heap = [(0.0, i) for i in range(par_cnt)]
+    for b in not_empty[np.argsort(-load[not_empty], kind='stable')]:
+        par_load, par_id = heapq.heappop(heap)
+        bucket_par[b] = par_id
+        heapq.heappush(heap, (par_load + load[b], par_id))
+    return bucket_par
+
+
+def id_cost_weight(df, id_col, id_cost):
+    """
+    根据每个id的计算量（比如上一次运行的耗时）计算每一行的权重，同一个id的行的权重之和等于这个id的计算量。
+    :param id_cost: dict 或者 Series，id -> 计算量，多个id字段时key是元组；没有记录的id按已知id计算量的中位数估计
+    :return: 每一行的权重
+    """
+    id_col = id_col if isinstance(id_col, list) else [id_col]
+    id_cost = pd.Series(id_cost, dtype=float)
+    if len(id_col) == 1:
+        key = df[id_col[0]].values
+    else:
+        key = pd.MultiIndex.from_frame(df[id_col])
+    cost = id_cost.reindex(key).to_numpy(copy=True)
+    cost[np.isnan(cost)] = id_cost.median() if len(id_cost) > 0 else 1.0
+    rows = df.groupby(id_col, sort=False, dropna=False)[id_col[0]].transform('size').values
+    return cost / rows
 
 
-def df_partition(df, cnt_perfile=None, id_col=None, path=None, prefix='prefix', par_cnt=10, to_pickle=False):
+def _split_rows(par_ids, par_cnt):
+    """按分区号把行号分组，返回 [(分区号, 行号数组), ...]，只排序一次，空分区不返回"""
+    order = np.argsort(par_ids, kind='stable')
+    bounds = np.searchsorted(par_ids[order], np.arange(par_cnt + 1))
+    return [(par_id, order[bounds[par_id]:bounds[par_id + 1]]) for par_id in range(par_cnt)
+            if bounds[par_id + 1] > bounds[par_id]]
+
+
+def hash_partition(df, id_col, par_cnt=10, weight_col=None, n_bucket=None, id_cost=None):
+    """
+    将dataframe按照id字段哈希分区，相同的id一定在同一个分区，返回 [(分区号, 子df), ...]，空分区不返回。
+    返回的分区按计算量从大到小排序，并行计算时先提交大的分区，小的分区留给先空闲的进程，尾部等待最短。
+    :param df: 数据
+    :param id_col: 分区字段，字符串或者list
+    :param par_cnt: 分区数量
+    :param weight_col: 权重字段，比如每一行的计算量，None 表示按行数均衡
+    :param n_bucket: 桶的数量，默认是分区数量的64倍（至少1024），桶越多越均衡
+    :param id_cost: 每个id的计算量，比如历史耗时，参见 id_cost_weight，和 weight_col 二选一
+    :return:
+    """
+    n_bucket = n_bucket if n_bucket else max(par_cnt * 64, 1024)
+    bucket = hash_bucket(df, id_col, n_bucket)
+    if id_cost is not None:
+        weight = id_cost_weight(df, id_col, id_cost)
+    else:
+        weight = df[weight_col].values.astype(float) if weight_col else None
+    par_ids = balance_buckets(bucket, par_cnt, weight, n_bucket)[bucket]
+    par_load = np.bincount(par_ids, weights=weight, minlength=par_cnt)
+    # 按分区号排序后切片，只需要一次取数，再按计算量从大到小排序
+    all_rows = _split_rows(par_ids, par_cnt)
+    all_rows.sort(key=lambda x: -par_load[x[0]])
+    return [(par_id, df.iloc[rows]) for par_id, rows in all_rows]
+
+
+def df_partition(df, cnt_perfile=None, id_col=None, path=None, prefix='prefix', par_cnt=10, to_pickle=False,
+                 weight_col=None, id_cost=None, return_rows=False):
     '''
     上面的一个函数是将file读取进来后分割，这里是对传进来的dataframe进行分割。
     将dataframe按照指定id_col字段进行分割成小文件。用于大文件的分割，后边用于并行计算。
@@ -102,40 +167,20 @@ def df_partition(df, cnt_perfile=None, id_col=None, path=None, prefix='prefix',
     :param id_col: 分组依据，也就是每个对象的id
     :param path: 存放的目录
     :param prefix: 保存子文件的前缀
-    :param par_cnt: 将df分割成多少个子文件，最多不超过100个
-    :param par_cnt: to_pickle 结果是否保存到pickle，更快
-    :return:
+    :param par_cnt: 将df分割成多少个子文件
+    :param to_pickle: 结果是否保存到pickle，更快
+    :param weight_col: 权重字段，分区时按权重之和均衡，None 表示按行数均衡
+    :param id_cost: 每个id的计算量，比如历史耗时，参见 hash_partition
+    :param return_rows: 是否同时返回每个子文件的行数
+    :return: 子文件列表，return_rows=True 时返回 (子文件列表, 每个子文件的行数)
     '''
-    # par_cnt = 15
-    # df=pd.DataFrame(pd.Series([str(i) for i in range(11)]),columns=['a'])
-    # id_col='a'
-    # all_par=list(range(100))
-    if isinstance(id_col, str):
-        df['hash_col'] = df[id_col].apply(lambda x: int(str(hash(x))[-2:]))  # 转哈希后取后两位数字用于分区
-    else:
-        df['tmp_hash_col'] = ''
-        for col in id_col:
-            df['tmp_hash_col'] = df['tmp_hash_col'] + df[col].apply(str)
-        df['hash_col'] = df['tmp_hash_col'].apply(lambda x: int(str(hash(x))[-3:]))  # 转哈希后取后两位数字用于分区
-        del df['tmp_hash_col']
-    # 计算分区数量
-    all_par = df['hash_col'].unique()
-    all_par.sort()  # 一定要排序，记得要排序
-    par_cnt = par_cnt if par_cnt < len(all_par) else len(all_par)
-    gap = round(len(all_par) / par_cnt)
-    all_par = [all_par[i: i + gap] for i in range(0, len(all_par), gap)]
+    all_par = hash_partition(df, id_col, par_cnt=par_cnt, weight_col=weight_col, id_cost=id_cost)
     print('一共有%d个分区' % len(all_par))
     # 每次取cnt个分区出来
     all_files = []
+    all_rows = []
     file_id = 1
-    for sub_par in all_par:
-        # 取出子集
-        min_, max_ = min(sub_par), max(sub_par)
-        if len(sub_par) == 1:
-            sub_df = df.loc[df['hash_col'] == min_]
-        else:
-            sub_df = df.loc[(df['hash_col'] >= min_) & (df['hash_col'] <= max_)]
-        del sub_df['hash_col']
+    for par_id, sub_df in all_par:
         # 保存
         if to_pickle:
             subfile_name = os.path.join(path, prefix + '_%03d.pickle' % file_id)
@@ -151,51 +196,20 @@ def df_partition(df, cnt_perfile=None, id_col=None, path=None, prefix='prefix',
         else:
             sub_df.to_csv(subfile_name, index=False)
         all_files.append(subfile_name)
-        print('分区数据 %s 保存到 %s，数据量：%d' % (str(sub_par), subfile_name, len(sub_df)))
+        all_rows.append(len(sub_df))
+        print('分区数据 %d 保存到 %s，数据量：%d' % (par_id, subfile_name, len(sub_df)))
         file_id += 1
     # 返回
+    if return_rows:
+        return all_files, all_rows
     return all_files
 
 
-def df_partition_not_to_file(df, id_col=None, par_cnt=10):
-    """将dataframe分拆成多个子df，要求相同的id在同一个子df中"""
-    # import numpy as np
-    # import pandas as pd
-    # from numpy import linspace
-    # df = pd.DataFrame(np.random.random((20,5)), columns=['c%d'%i for i in range(5)])
-    # id_col=['c0','c1']
-    # par_cnt=3
-    # 创建tmp列，用来计算hash分区id
-    if isinstance(id_col, str):
-        df['hash_col'] = df[id_col].apply(lambda x: int(str(hash(x))[-2:]))  # 转哈希后取后两位数字用于分区
-    else:
-        df['tmp_hash_col'] = ''
-        for col in id_col:
-            df['tmp_hash_col'] = df['tmp_hash_col'] + df[col].apply(str)
-        df['hash_col'] = df['tmp_hash_col'].apply(lambda x: int(str(hash(x))[-2:]))  # 转哈希后取后两位数字用于分区
-        del df['tmp_hash_col']
-    # 计算分区数量
-    all_par = df['hash_col'].unique()
-    all_par.sort()  # 一定要排序，记得要排序
-    par_cnt = par_cnt if par_cnt < len(all_par) else len(all_par)
-    gap = round(len(all_par) / par_cnt)
-    all_par = [all_par[i: i + gap] for i in range(0, len(all_par), gap)]
+def df_partition_not_to_file(df, id_col=None, par_cnt=10, weight_col=None, id_cost=None):
+    """将dataframe分拆成多个子df，要求相同的id在同一个子df中，weight_col、id_cost 参见 hash_partition"""
+    all_par = hash_partition(df, id_col, par_cnt=par_cnt, weight_col=weight_col, id_cost=id_cost)
     print('一共有%d个分区' % len(all_par))
-    # 每次取cnt个分区出来
-    all_sub_data = []
-    file_id = 1
-    for sub_par in all_par:
-        # 取出子集
-        min_, max_ = min(sub_par), max(sub_par)
-        if len(sub_par) == 1:
-            sub_df = df.loc[df['hash_col'] == min_]
-        else:
-            sub_df = df.loc[(df['hash_col'] >= min_) & (df['hash_col'] <= max_)]
-        del sub_df['hash_col']
-        all_sub_data.append(sub_df)
-        file_id += 1
-    # 返回
-    return all_sub_data
+    return [sub_df for par_id, sub_df in all_par]
 
 
 def _test_df_partition():
@@ -1,58 +1,32 @@
 """
-在这里进行并行计算，其他模块参考这个函数编写多进程代码
+在这里进行并行计算，其他模块参考这个函数编写多进程/多线程代码
+进程池、线程池都用 parallel_func.worker_pool，只是 backend 不同：
+    process：多进程，适合纯python的计算
+    thread：多线程，适合 numpy、数据库读写等会释放GIL的任务
+    inline：在当前线程中顺序执行，方便调试
 """
-from multiprocessing import Pool    # 进程池
-from threading import Thread        # 线程
+from .parallel_func import worker_pool
 
 # -----------------------------------------------------------------------------------
-# 进程池
-# 第一步：定义需要并行的函数
-def parallel_func(func,*args,**kwargs):
+# 第一步：定义需要并行的函数，只接收一个参数，多进程时必须是模块顶层定义的函数
+def parallel_func(args):
     """需要并行的函数，在实际应用中需要重写这个函数"""
-    return func(*args,**kwargs)
+    data, params = args
+    return data
 
-# 第二步：组装参数，对应parallel_func的参数
-all_data=None
-all_params=None
-tasks=[[data, params] for data,params in zip(all_data, all_params)]
-
-# 第三步：并行计算
-def parallel(func, tasks, n_cpu):
-    """并行计算"""
-    pool=Pool(n_cpu)
-    result=pool.map(func, iterable=tasks)
-    pool.close()
-    pool.join()
-    return result
 
+# 第二步：组装参数，对应parallel_func的参数
+def make_tasks(all_data, all_params):
+    return [[data, params] for data, params in zip(all_data, all_params)]
 
-# -----------------------------------------------------------------------------------
-# 线程池
-# 第一步：定义需要并行的函数
-def parallel_func(func,*args,**kwargs):
-    return func(*args,**kwargs)
-
-# 第二步，组装参数，对应parallel_func的参数
-all_data=None
-all_params=None
-tasks=[[data, params] for data,params in zip(all_data, all_params)]
 
 # 第三步：并行计算
-def parallel(tasks):
-    """并行计算"""
-    all_tasks=[]
-    # 创建线程
-    for t_p in tasks:
-        thread = Thread(target=parallel_func, args=t_p)
-        all_tasks.append(thread)
-    # 启动线程
-    for t in all_tasks:
-        t.start()
-    # 等待结束
-    for t in all_tasks:
-        t.join()
-
-
-
+def parallel(func, tasks, n_cpu, backend='process'):
+    """并行计算，按 tasks 的顺序返回结果"""
+    with worker_pool(n_cpu, backend=backend) as pool:
+        return pool.map(func, tasks)
 
 
+def _test():
+    tasks = make_tasks(range(10), ['a'] * 10)
+    print(parallel(parallel_func, tasks, n_cpu=2, backend='thread'))
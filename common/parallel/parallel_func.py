@@ -16,11 +16,42 @@ func 的处理流程必须是：
 
 具体的使用方法，参见 test 函数
 
+如果分区数据很大，pickle临时文件来回读写很慢，可以使用 io_mode='shm'，通过共享内存传递数据，这时 func 的约定是：
+func(df, other_params) -> result_df
+    df: 分区数据（只读，数值列直接指向共享内存）
+    result_df: 计算结果
+
+子进程算完一个分区，父进程就马上读取这个分区的结果（imap_unordered），所以结果的顺序是完成的先后顺序，不是分区顺序。
+结果很大、不需要全部留在内存时，可以传 sink，每个分区的结果交给 sink(sub_result_df) 处理后就释放，
+比如写文件（参见 csv_sink）或者写数据库，这时 parallel 返回结果的总行数。
+
+一次任务里面要调用很多次 parallel 的话，可以先创建一个 worker_pool，每次调用都传 pool=，子进程只启动一次，
+加载模型等比较重的初始化也只在每个子进程启动时做一次（initializer），用完后 close：
+    with worker_pool(n_cpu=8, initializer=load_model) as pool:
+        df1 = parallel(func1, ..., pool=pool)
+        df2 = parallel(func2, ..., pool=pool)
+
+worker_pool 有三种后端，parallel 的 backend 参数也一样：
+    process：多进程，默认，适合纯python的计算
+    thread：多线程，适合 numpy、数据库读写等会释放GIL的任务，不需要启动子进程，func 也不需要能pickle
+    inline：在当前线程中顺序执行，方便调试
+io_mode='memory' 时直接把分区的dataframe传给 func(df, *func_params)，不读写临时文件，
+配合 thread/inline 后端完全没有拷贝和序列化；process 后端也能用，数据通过进程池的管道pickle传递。
+
+有少数id数据量特别大时，可以用 oversplit 把数据切成 partition_cnt*oversplit 个小任务，大任务先提交，
+哪个进程先空闲就先领取下一个任务，不会因为某一个分区特别大而让其他进程空等；
+每个id的计算量和行数不成比例时，可以传 id_cost（比如上一次运行每个id的耗时），按计算量均衡分区。
+
 """
 import pandas as pd
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import datetime
 import os
+import sys
+import time
+import queue
+import threading
 from ...config.config import ex_data
 from ..database import pyfile
 from . import data_partition
@@ -45,8 +76,472 @@ def old_data(path, prefix):
             os.remove(os.path.join(path, file))
 
 
+class csv_sink():
+    """把每个分区的结果追加写到同一个csv文件，作为 parallel 的 sink 使用，只在第一次写入时写列名"""
+
+    def __init__(self, file, **kwargs):
+        self.file = file
+        self.kwargs = kwargs
+        self.header = True
+        if os.path.exists(file):
+            os.remove(file)
+
+    def __call__(self, df):
+        df.to_csv(self.file, mode='a', header=self.header, index=False, **self.kwargs)
+        self.header = False
+
+
+worker_data = {}  # 子进程中 initializer 的返回结果，参见 worker_pool
+
+
+def _init_worker(initializer, initargs):
+    """子进程启动时执行一次，initializer 的返回结果保存在 worker_data['init']"""
+    if initializer is not None:
+        worker_data['init'] = initializer(*initargs)
+
+
+def get_worker_data():
+    """在 func 中获取本子进程 initializer 的返回结果，比如加载好的模型"""
+    return worker_data.get('init')
+
+
+def available_memory():
+    """当前系统可用内存（MB），优先用psutil，没有安装的话读 /proc/meminfo，都拿不到返回 None"""
+    try:
+        import psutil
+        return psutil.virtual_memory().available / 1024 / 1024
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+class _inline_pool():
+    """在当前线程中顺序执行任务，接口和 multiprocessing.Pool 一样，给 worker_pool 的 inline 后端用"""
+
+    def __init__(self, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        try:
+            result = func(*args)
+        except Exception as e:
+            if error_callback is None:
+                raise
+            error_callback(e)
+            return
+        if callback is not None:
+            callback(result)
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def _peak_rss():
+    """
+    当前进程从启动到现在的内存峰值（MB），不是某一个任务的峰值：子进程复用时，后面的任务会沿用前面任务涨上去的峰值；
+    thread/inline 后端是主进程的峰值。windows下没有 resource 模块，返回 None
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def _current_rss():
+    """当前进程占用的内存（MB），优先用psutil，没有安装的话读 /proc/self/statm，都拿不到返回 None"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (IOError, ValueError, AttributeError):
+        return None
+
+
+def _timed_task(args):
+    """
+    执行任务并计时，返回 (结果, 开始时间, 结束时间, 进程id, 任务前后的内存变化MB, 进程内存峰值MB)。
+    内存变化是任务结束时减去开始时的内存，任务中间临时用掉又释放的内存不算；thread 后端多个任务同时运行，互相有影响
+    """
+    func, task_args = args
+    rss = _current_rss()
+    start = time.time()
+    result = func(task_args)
+    end = time.time()
+    rss_delta = _current_rss() - rss if rss is not None else None
+    return result, start, end, os.getpid(), rss_delta, _peak_rss()
+
+
+def _indexed_task(args):
+    """worker_pool.map 执行的函数，带上任务序号返回，用于恢复输入顺序"""
+    func, i, task_args = args
+    return i, func(task_args)
+
+
+def task_summary(metrics, top=10):
+    """把 worker_pool.last_metrics 汇总成字符串：总体情况 + 运行最慢的 top 个任务"""
+    if not metrics:
+        return '没有任务'
+    df = pd.DataFrame(metrics)
+    string = '任务数：%d，重试：%d 次，慢任务：%d 个，运行耗时 合计 %.1f 秒 / 中位数 %.1f 秒 / 最大 %.1f 秒，排队等待 合计 %.1f 秒' % (
+        len(df), (df['attempts'] - 1).sum(), df['straggler'].sum(), df['run'].sum(), df['run'].median(),
+        df['run'].max(), df['queue_wait'].sum())
+    cols = [c for c in ['task', 'pid', 'attempts', 'queue_wait', 'run', 'rows_in', 'rows_out', 'rss_delta_mb', 'worker_peak_rss_mb',
+                        'straggler', 'speculated'] if c in df.columns]
+    slow = df.sort_values('run', ascending=False).head(top)[cols].round(2)
+    return string + '\n' + slow.to_string(index=False)
+
+
+def _run_df_task(args):
+    """io_mode='memory' 时执行的函数，args = (func, df, func_params)"""
+    func, df, func_params = args
+    return func(df, *func_params)
+
+
+class worker_pool():
+    """
+    常驻的进程池，可以给多次 parallel 调用共用，避免每次都重新创建子进程、重新import和加载模型。
+    :param n_cpu: 子进程数量
+    :param initializer: 每个子进程启动时执行一次的函数，返回的对象在func中用 get_worker_data() 获取
+    :param initargs: initializer 的参数
+    :param max_queue: 最多同时提交多少个任务，默认是子进程数量的2倍，剩下的任务等前面的完成后再提交，
+                      避免一次把所有任务的参数都塞进队列
+    :param maxtasksperchild: 每个子进程最多执行多少个任务后重启，释放计算过程中涨上去的内存，None 表示不重启
+    :param mem_budget: 已提交任务的内存上限（MB），参见 imap_unordered
+    :param backend: process 多进程，thread 多线程，inline 在当前线程中顺序执行
+    """
+
+    def __init__(self, n_cpu=None, initializer=None, initargs=(), max_queue=None, maxtasksperchild=None,
+                 mem_budget=None, backend='process'):
+        self.n_cpu = n_cpu if n_cpu else os.cpu_count()
+        self.max_queue = max_queue if max_queue else self.n_cpu * 2
+        self.mem_budget = mem_budget
+        self.backend = backend
+        if backend == 'process':
+            self.pool = Pool(self.n_cpu, initializer=_init_worker, initargs=(initializer, initargs),
+                             maxtasksperchild=maxtasksperchild)
+        elif backend == 'thread':
+            self.pool = ThreadPool(self.n_cpu, initializer=_init_worker, initargs=(initializer, initargs))
+        elif backend == 'inline':
+            self.pool = _inline_pool(initializer=_init_worker, initargs=(initializer, initargs))
+        else:
+            raise Exception('backend 只能是 process、thread、inline，不支持：%s' % backend)
+
+    def imap_unordered(self, func, iterable, task_mem=None, mem_budget=None, task_info=None, retries=0,
+                       straggler_factor=3, speculative=False, discard=None):
+        """
+        对 iterable 中的每个参数执行 func(args)，按完成的先后顺序返回结果。
+        同时在队列中的任务不超过 max_queue 个，iterable 是按需读取的，可以是生成器。
+        传了 task_mem 的话，还会控制已提交任务的内存之和不超过 mem_budget，超过了就等前面的任务完成后再提交，
+        单个任务超过 mem_budget 时，等其他任务都完成后单独执行。
+        每完成一个任务，在 self.last_metrics 中追加一条这个任务的指标（排队等待、运行耗时、任务前后的内存变化、
+        执行任务的进程的内存峰值等），参见 task_summary。
+        :param task_mem: 估计每个任务需要多少内存（MB）的函数 task_mem(args)
+        :param mem_budget: 内存上限（MB），默认用 worker_pool 的 mem_budget，没有的话用当前系统可用内存的80%
+        :param task_info: 函数 task_info(args)，返回dict，加到这个任务的指标中，比如 {'rows_in': 行数}
+        :param retries: 任务失败后单独重试几次，重试次数用完还失败才抛出异常，其他任务的结果不受影响
+        :param straggler_factor: 一个任务提交后超过 已完成任务耗时中位数*straggler_factor 还没完成，就认为是慢任务
+        :param speculative: 是否给慢任务再提交一份副本，哪份先完成用哪份，要求 func 重复执行没有副作用
+        :param discard: 处理被丢弃的副本结果的函数 discard(result)，比如删除副本写的共享内存
+        """
+        if task_mem is not None:
+            mem_budget = mem_budget if mem_budget else self.mem_budget
+            if not mem_budget:
+                available = available_memory()
+                mem_budget = available * 0.8 if available else None
+        self.last_metrics = []
+        self._tasks = {}  # 任务序号 -> 任务状态
+        self._lock = threading.Lock()
+        done = queue.Queue()
+        running = {}  # 还没完成的任务序号 -> 估计的内存
+        for task_id, args in enumerate(iterable):
+            need = task_mem(args) if task_mem is not None and mem_budget else 0
+            while running and (len(running) >= self.max_queue or
+                               (need > 0 and sum(running.values()) + need > mem_budget)):
+                ok, result = self._next(func, done, running, retries, straggler_factor, speculative, discard)
+                if ok:
+                    yield result
+            running[task_id] = need
+            self._tasks[task_id] = {'args': args, 'attempt': 1, 'copies': 0, 'finished': False, 'straggler': False,
+                                    'speculated': False, 'info': task_info(args) if task_info else {}}
+            self._submit(func, done, task_id, discard)
+        while running:
+            ok, result = self._next(func, done, running, retries, straggler_factor, speculative, discard)
+            if ok:
+                yield result
+
+    def _submit(self, func, done, task_id, discard):
+        """提交一次任务（第一次、重试或者副本）"""
+        task = self._tasks[task_id]
+        task['copies'] += 1
+        task['submit_time'] = time.time()
+
+        def on_done(ok, result, submit_time=task['submit_time']):
+            # 在进程池的结果线程中执行；任务已经有一份完成了的话，直接丢弃这份结果
+            with self._lock:
+                task['copies'] -= 1
+                late = task['finished']
+            if not late:
+                done.put((task_id, submit_time, ok, result))
+            elif ok and discard is not None:
+                discard(result[0])
+
+        self.pool.apply_async(_timed_task, ((func, task['args']),), callback=lambda r: on_done(True, r),
+                              error_callback=lambda e: on_done(False, e))
+
+    def _next(self, func, done, running, retries, straggler_factor, speculative, discard):
+        """
+        等待并处理一个完成的任务，返回 (True, 结果)；
+        如果处理的是失败后重试、或者多余的副本，返回 (False, None)
+        """
+        while True:
+            try:
+                task_id, submit_time, ok, result = done.get(timeout=1)
+                break
+            except queue.Empty:
+                self._check_straggler(func, done, straggler_factor, speculative, discard)
+        task = self._tasks[task_id]
+        if task['finished']:
+            # 两份副本几乎同时完成
+            if ok and discard is not None:
+                discard(result[0])
+            return False, None
+        if not ok:
+            if task['copies'] > 0:
+                return False, None  # 还有副本在运行，等副本的结果
+            if task['attempt'] > retries:
+                raise result
+            task['attempt'] += 1
+            print('任务 %d 失败，第 %d 次重试：%s' % (task_id, task['attempt'] - 1, repr(result)))
+            self._submit(func, done, task_id, discard)
+            return False, None
+        result, start, end, pid, rss_delta, peak_rss = result
+        with self._lock:
+            task['finished'] = True
+        del running[task_id]
+        metric = {'task': task_id, 'pid': pid, 'attempts': task['attempt'], 'queue_wait': start - submit_time,
+                  'run': end - start, 'rss_delta_mb': rss_delta, 'worker_peak_rss_mb': peak_rss, 'straggler': task['straggler'],
+                  'speculated': task['speculated']}
+        if isinstance(result, pd.DataFrame):
+            metric['rows_out'] = len(result)
+        metric.update(task['info'])
+        self.last_metrics.append(metric)
+        task['args'] = None  # 释放参数，memory模式下是分区数据
+        return True, result
+
+    def _check_straggler(self, func, done, straggler_factor, speculative, discard):
+        """
+        已完成任务耗时的中位数*straggler_factor 作为阈值，找出超过阈值还没完成的任务。
+        任务按提交顺序执行，只有最早提交的 n_cpu 个未完成任务可能正在运行，后面的还在排队，不算慢任务。
+        """
+        if not self.last_metrics or not straggler_factor:
+            return
+        limit = max(pd.Series([m['queue_wait'] + m['run'] for m in self.last_metrics]).median() * straggler_factor, 1)
+        now = time.time()
+        unfinished = [(task['submit_time'], task_id) for task_id, task in self._tasks.items()
+                      if not task['finished'] and task['copies'] > 0]
+        for submit_time, task_id in sorted(unfinished)[:self.n_cpu]:
+            task = self._tasks[task_id]
+            if task['straggler'] or now - submit_time < limit:
+                continue
+            task['straggler'] = True
+            print('任务 %d 已经 %.1f 秒还没完成，超过已完成任务耗时中位数的 %s 倍' % (task_id, now - task['submit_time'],
+                                                                 straggler_factor))
+            if speculative:
+                task['speculated'] = True
+                self._submit(func, done, task_id, discard)
+
+    def map(self, func, iterable):
+        """和 Pool.map 一样，等全部完成后按 iterable 的顺序返回结果；不需要顺序的话用 imap_unordered，边完成边处理"""
+        results = {}
+        for i, result in self.imap_unordered(_indexed_task, ((func, i, args) for i, args in enumerate(iterable))):
+            results[i] = result
+        return [results[i] for i in range(len(results))]
+
+    def close(self):
+        # 还有多余的副本在运行的话，结果已经不需要了，直接结束子进程；线程没法结束，不等它们，让它们在后台跑完
+        if any(t['finished'] and t['copies'] > 0 for t in getattr(self, '_tasks', {}).values()):
+            if self.backend == 'process':
+                self.terminate()
+            else:
+                self.pool.close()
+            return
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+def parallel_memory(func, func_params=None, df=None, id_col=[], partition_cnt=1, n_cpu=None, result_file='',
+                    weight_col=None, sink=None, pool=None, oversplit=1, id_cost=None, mem_budget=None, mem_factor=3,
+                    backend='thread', retries=0, speculative=False):
+    """
+    parallel 的内存版本（io_mode='memory'），直接把分区的dataframe传给 func(df, *func_params)，返回结果dataframe，
+    不读写临时文件。适合 thread/inline 后端，数据不拷贝也不序列化。
+    """
+    t1 = datetime.datetime.now()
+    id_col = id_col if isinstance(id_col, list) else [id_col]
+    func_params = func_params if isinstance(func_params, list) else [func_params]
+    all_sub_df = data_partition.df_partition_not_to_file(df, id_col=id_col, par_cnt=partition_cnt * oversplit,
+                                                           weight_col=weight_col, id_cost=id_cost)
+    all_result_data = []
+    row_cnt = 0
+    own_pool = pool is None
+    if own_pool:
+        pool = worker_pool(n_cpu if n_cpu else min(partition_cnt, os.cpu_count()), backend=backend)
+    try:
+        for sub_data in pool.imap_unordered(_run_df_task, [(func, sub_df, func_params) for sub_df in all_sub_df],
+                                            task_mem=lambda args: args[1].memory_usage().sum() / 1024 / 1024 * mem_factor,
+                                            mem_budget=mem_budget, task_info=lambda args: {'rows_in': len(args[1])},
+                                            retries=retries, speculative=speculative):
+            row_cnt += len(sub_data)
+            if sink is None:
+                all_result_data.append(sub_data)
+            else:
+                sink(sub_data)
+    except BaseException:
+        # 出错时不等队列里剩下的任务，直接结束
+        if own_pool:
+            pool.terminate()
+        raise
+    if own_pool:
+        pool.close()
+    print('完成所有子数据集的并行计算，每个任务的耗时统计：\n' + task_summary(pool.last_metrics))
+    t2 = datetime.datetime.now()
+    if sink is not None:
+        print('完成全部并行计算，结果交给sink处理，一共 %d 行，耗时：%d 秒' % (row_cnt, (t2 - t1).seconds))
+        return row_cnt
+    all_result_data = pd.concat(all_result_data) if all_result_data else pd.DataFrame()
+    if result_file:
+        pypickle.write(result_file, all_result_data)
+        print('结果写到文件：%s' % result_file)
+    print('完成全部并行计算，耗时：%d 秒' % (t2 - t1).seconds)
+    if result_file:
+        return result_file
+    else:
+        return all_result_data
+
+
+def parallel_shm(func, func_params=None, df=None, id_col=[], partition_cnt=1, n_cpu=None, result_file='',
+                 weight_col=None, sink=None, pool=None, oversplit=1, id_cost=None, mem_budget=None, mem_factor=3,
+                 maxtasksperchild=None, backend='process', retries=0, speculative=False):
+    """
+    parallel 的共享内存版本（io_mode='shm'），分区数据和结果都通过共享内存传递，不读写临时文件.
+    func 的约定和pickle方式不同：func(df, *func_params)，直接传入分区的dataframe（只读），返回结果dataframe。
+    func 必须是模块顶层定义的函数（子进程要能pickle它）。
+    """
+    from . import shared_data  # 需要pyarrow，只在共享内存模式下导入
+    t1 = datetime.datetime.now()
+    id_col = id_col if isinstance(id_col, list) else [id_col]
+    func_params = func_params if isinstance(func_params, list) else [func_params]
+    # 第一步，分割数据集，每个分区写到一块共享内存
+    all_sub_df = data_partition.df_partition_not_to_file(df, id_col=id_col, par_cnt=partition_cnt * oversplit,
+                                                           weight_col=weight_col, id_cost=id_cost)
+    all_input = []
+    rows_in = {}  # 共享内存名称 -> 分区行数
+    for sub_df in all_sub_df:
+        all_input.append(shared_data.put_df(sub_df))
+        rows_in[all_input[-1][0]] = len(sub_df)
+    all_sub_df = sub_df = None  # 释放分区数据，没有分区时 sub_df 没有赋值过，不能用 del
+    t2 = datetime.datetime.now()
+    print('数据切分耗时：%d秒，切分成 %d 个共享内存分区' % ((t2 - t1).seconds, len(all_input)))
+    # 第二步，并行计算，每完成一个分区就读取一个分区的结果
+    all_result = []
+    opened = []
+    row_cnt = 0
+    own_pool = pool is None
+    try:
+        if own_pool:
+            pool = worker_pool(n_cpu if n_cpu else min(partition_cnt, os.cpu_count()),
+                               maxtasksperchild=maxtasksperchild, backend=backend)
+        try:
+            for name, size in pool.imap_unordered(shared_data.run_task, [(func, name_size, func_params)
+                                                                         for name_size in all_input],
+                                                  task_mem=lambda args: args[1][1] / 1024 / 1024 * mem_factor,
+                                                  mem_budget=mem_budget,
+                                                  task_info=lambda args: {'rows_in': rows_in[args[1][0]]},
+                                                  retries=retries, speculative=speculative,
+                                                  discard=lambda result: shared_data.remove(result[0])):
+                all_result.append((name, size))
+                sub_df, shm = shared_data.open_df(name, size)
+                row_cnt += len(sub_df)
+                pool.last_metrics[-1]['rows_out'] = len(sub_df)  # 刚完成的任务的指标
+                if sink is None:
+                    opened.append((sub_df, shm))  # 零拷贝的结果先留在共享内存，最后一次性合并
+                    continue
+                sink(sub_df)
+                del sub_df
+                shared_data.close(shm, unlink=True)
+        except BaseException:
+            # 出错时不等队列里剩下的任务，直接结束
+            if own_pool:
+                pool.terminate()
+            raise
+        if own_pool:
+            pool.close()
+        print('完成所有子数据集的并行计算，每个任务的耗时统计：\n' + task_summary(pool.last_metrics))
+        # 第三步，所有结果一次性合并
+        if sink is None:
+            all_result_data = pd.concat([sub_df for sub_df, shm in opened]) if opened else pd.DataFrame()
+            for i in range(len(opened)):
+                shm = opened[i][1]
+                opened[i] = None
+                shared_data.close(shm, unlink=True)
+    finally:
+        # 删除共享内存，出错时也要删除，否则会一直占用内存；已经删除的会被忽略
+        opened = []
+        for name, size in all_input + all_result:
+            shared_data.remove(name)
+    if sink is not None:
+        t2 = datetime.datetime.now()
+        print('完成全部并行计算，结果交给sink处理，一共 %d 行，耗时：%d 秒' % (row_cnt, (t2 - t1).seconds))
+        return row_cnt
+    print('读取并行计算子集的结果，组装成一个大的dataframe')
+    if result_file:
+        pypickle.write(result_file, all_result_data)
+        print('结果写到文件：%s' % result_file)
+    t2 = datetime.datetime.now()
+    print('完成全部并行计算，耗时：%d 秒' % (t2 - t1).seconds)
+    if result_file:
+        return result_file
+    else:
+        return all_result_data
+
+
 def parallel(func, func_params=None, df=None, id_col=[], partition_cnt=1, n_cpu=None,
-             path=None, prefix='', result_file=''):
+             path=None, prefix='', result_file='', io_mode='pickle', weight_col=None, sink=None, pool=None,
+             oversplit=1, id_cost=None, mem_budget=None, mem_factor=3, maxtasksperchild=None, backend='process',
+             retries=0, speculative=False):
     """
     对df进行分割分组，然后对每个分组应用相同的func函数
     :param func: 需要运算的函数
@@ -54,12 +549,40 @@ def parallel(func, func_params=None, df=None, id_col=[], partition_cnt=1, n_cpu=
     :param df: 整体数据集
     :param id_col: 分区字段
     :param partition_cnt: 需要分区的数量
-    :param n_cpu: 并行cpu数量
+    :param weight_col: 权重字段（比如每一行的计算量），分区时按权重之和均衡，None 表示按行数均衡
+    :param id_cost: 每个id的计算量（比如历史耗时），dict 或者 Series，和 weight_col 二选一
+    :param oversplit: 实际切分成 partition_cnt*oversplit 个任务，大任务先提交，空闲的进程领取剩下的小任务
+    :param mem_budget: 同时计算的任务的内存上限（MB），默认是当前系统可用内存的80%，超过了就等前面的任务完成再提交
+    :param mem_factor: 估计一个任务需要的内存 = 分区数据大小 * mem_factor（输入、中间结果、输出）
+    :param maxtasksperchild: 每个子进程最多执行多少个任务后重启，释放内存，只在没有传 pool 时起作用
+    :param backend: process 多进程，thread 多线程，inline 在当前线程中顺序执行，只在没有传 pool 时起作用
+    :param retries: 分区计算失败后单独重试几次，其他分区的结果不受影响
+    :param speculative: 慢任务（超过已完成任务耗时中位数3倍）是否再提交一份副本，哪份先完成用哪份，
+                        要求 func 重复执行没有副作用；pickle 模式两份副本会写同一个结果文件，所以只提示不重跑
+    :param n_cpu: 并行cpu数量，默认是分区数量，但不超过机器的cpu数量
     :param path: 临时数据目录
     :param prefix: 临时数据文件的前缀
     :param result_file: 将结果保存到文件并返回文件名，否则返回并行计算的结果
+    :param io_mode: 分区数据和结果怎么在进程之间传递
+                    pickle：写pickle临时文件，func(input_file, output_file, *func_params)
+                    shm：共享内存，不读写临时文件，func(df, *func_params) 返回dataframe，参见 parallel_shm
+                    memory：直接传dataframe，func 的约定和 shm 一样，适合 thread/inline 后端，参见 parallel_memory
+    :param sink: 每个分区结果的处理函数 sink(sub_result_df)，比如 csv_sink 或者写数据库，
+                 传了sink的话结果不在内存中合并，也不写 result_file，返回结果的总行数
+    :param pool: 常驻的进程池 worker_pool，传了的话用这个进程池计算，用完不关闭，n_cpu 不起作用
     :return:
     """
+    if io_mode == 'memory':
+        return parallel_memory(func, func_params=func_params, df=df, id_col=id_col, partition_cnt=partition_cnt,
+                               n_cpu=n_cpu, result_file=result_file, weight_col=weight_col, sink=sink, pool=pool,
+                               oversplit=oversplit, id_cost=id_cost, mem_budget=mem_budget, mem_factor=mem_factor,
+                               backend=backend, retries=retries, speculative=speculative)
+    if io_mode == 'shm':
+        return parallel_shm(func, func_params=func_params, df=df, id_col=id_col, partition_cnt=partition_cnt,
+                            n_cpu=n_cpu, result_file=result_file, weight_col=weight_col, sink=sink, pool=pool,
+                            oversplit=oversplit, id_cost=id_cost, mem_budget=mem_budget, mem_factor=mem_factor,
+                            maxtasksperchild=maxtasksperchild, backend=backend, retries=retries,
+                            speculative=speculative)
     t1=datetime.datetime.now()
     # 本批次处理
     batch='parallel_%s_'%datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -80,7 +603,10 @@ def parallel(func, func_params=None, df=None, id_col=[], partition_cnt=1, n_cpu=
     # 第一步，分割数据集
     id_col = id_col if isinstance(id_col, list) else [id_col]   # 分割数据集的id字段，相同的ID数据分在同一个子集中
     t1=datetime.datetime.now()
-    all_sub_dat_file = data_partition.df_partition(df, id_col=id_col, path=path, prefix=split_prefix, par_cnt=partition_cnt, to_pickle=True)
+    all_sub_dat_file, all_rows = data_partition.df_partition(df, id_col=id_col, path=path, prefix=split_prefix,
+                                                             par_cnt=partition_cnt * oversplit, to_pickle=True,
+                                                             weight_col=weight_col, id_cost=id_cost, return_rows=True)
+    rows_in = dict(zip(all_sub_dat_file, all_rows))  # 子文件 -> 分区行数
     t2=datetime.datetime.now()
     print('数据切分耗时：%d秒，切分成 %d 个子文件'%((t2-t1).seconds, len(all_sub_dat_file)))
     # -------------------------------------------------------------------------------------------------------
@@ -103,22 +629,41 @@ def parallel(func, func_params=None, df=None, id_col=[], partition_cnt=1, n_cpu=
         sub_param.extend(func_params)           # 第三个到最后一个是 其他参数
         all_params.append(sub_param)
     # -------------------------------------------------------------------------------------------------------
-    # 并行计算
-    n_cpu = n_cpu if n_cpu else partition_cnt
-    pool = Pool(n_cpu)
-    parallel_result_file = pool.map(func, iterable=all_params)
-    pool.close()
-    pool.join()
-    print('完成所有子数据集的并行计算')
+    # 并行计算，每完成一个分区就读取一个分区的结果，读完马上删除结果文件
+    all_result_data = []
+    row_cnt = 0
+    own_pool = pool is None
+    if own_pool:
+        pool = worker_pool(n_cpu if n_cpu else min(partition_cnt, os.cpu_count()), maxtasksperchild=maxtasksperchild,
+                           backend=backend)
+    try:
+        for sub_result_file in pool.imap_unordered(func, all_params,
+                                                   task_mem=lambda args: os.path.getsize(args[0]) / 1024 / 1024 * mem_factor,
+                                                   mem_budget=mem_budget, task_info=lambda args: {'rows_in': rows_in[args[0]]},
+                                                   retries=retries):
+            sub_data = pypickle.read(sub_result_file)
+            os.remove(sub_result_file)
+            row_cnt += len(sub_data)
+            pool.last_metrics[-1]['rows_out'] = len(sub_data)  # 刚完成的任务的指标
+            if sink is None:
+                all_result_data.append(sub_data)
+            else:
+                sink(sub_data)
+    except BaseException:
+        # 出错时不等队列里剩下的任务，直接结束
+        if own_pool:
+            pool.terminate()
+        raise
+    if own_pool:
+        pool.close()
+    print('完成所有子数据集的并行计算，每个任务的耗时统计：\n' + task_summary(pool.last_metrics))
     # -------------------------------------------------------------------------------------------------------
-    # 读取并行计算子集的结果，组装成一个大的dataframe
-    all_result_data = pd.DataFrame()
-    for sub_result_file in parallel_result_file:
-        sub_data = pypickle.read(sub_result_file)
-        all_result_data = pd.concat([all_result_data, sub_data])
-    print('读取并行计算子集的结果，组装成一个大的dataframe')
+    # 所有结果一次性合并成一个大的dataframe
+    if sink is None:
+        all_result_data = pd.concat(all_result_data) if all_result_data else pd.DataFrame()
+        print('读取并行计算子集的结果，组装成一个大的dataframe')
     # 结果是否写文件
-    if result_file:
+    if result_file and sink is None:
         pypickle.write(result_file, all_result_data)
         print('结果写到文件：%s'%result_file)
     # -------------------------------------------------------------------------------------------------------
@@ -129,6 +674,8 @@ def parallel(func, func_params=None, df=None, id_col=[], partition_cnt=1, n_cpu=
     t2 = datetime.datetime.now()
     print('完成全部并行计算，耗时：%d 秒'%(t2-t1).seconds)
     # 返回
+    if sink is not None:
+        return row_cnt
     if result_file:
         return result_file
     else:
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+通过共享内存在进程之间传递dataframe，给 parallel_func.parallel 的 io_mode='shm' 使用。
+
+pickle文件的方式，一个分区要经过 父进程写pickle -> 子进程读pickle -> 子进程写结果pickle -> 父进程读结果pickle，
+四次完整的序列化加上磁盘读写。这里把dataframe转成arrow的IPC格式直接写进共享内存（multiprocessing.shared_memory），
+另一个进程按名字挂载这块共享内存后，arrow直接在这块内存上读取，数值列不需要拷贝。
+
+需要安装 pyarrow，python3.8以上。
+
+约定：
+1、put_df 返回 (name, size)，这个元组可以pickle，传给其他进程
+2、open_df 零拷贝读取，返回的dataframe的数值列直接指向共享内存（只读），用完后 close；get_df 读取一份拷贝
+3、谁最后用完谁删除，parallel 中输入由父进程删除，结果由父进程读取后删除
+"""
+import pyarrow as pa
+from multiprocessing import shared_memory, resource_tracker
+
+
+def _attach(name):
+    """
+    挂载已经存在的共享内存。
+    python3.13之前，挂载时也会在resource_tracker登记，进程退出时会被误删或者报泄露警告，所以这里取消登记，
+    共享内存的生命周期由创建者和 get_df(unlink=True) 负责。
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+def _write_table(table, shm):
+    """将arrow表写到共享内存。单独一个函数，返回后对 shm.buf 的引用都释放了，shm才能close"""
+    stream = pa.FixedSizeBufferWriter(pa.py_buffer(shm.buf))
+    with pa.ipc.new_stream(stream, table.schema) as writer:
+        writer.write_table(table)
+    stream.close()
+
+
+def put_df(df):
+    """将dataframe写到一块新的共享内存，返回 (name, size)"""
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    # 先算出需要多大的内存
+    sink = pa.MockOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    size = sink.size()
+    # 再写到共享内存
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    _write_table(table, shm)
+    name = shm.name
+    shm.close()
+    # 创建者进程退出时不要自动删除，由读取的一方删除
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return name, size
+
+
+def open_df(name, size):
+    """
+    从共享内存零拷贝地读取dataframe，返回 (df, shm)。
+    数值列直接指向共享内存（只读），用完后要先删除df的引用，再调用 close(shm)。
+    """
+    shm = _attach(name)
+    buf = pa.py_buffer(shm.buf)[:size]
+    table = pa.ipc.open_stream(buf).read_all()
+    df = table.to_pandas(split_blocks=True)
+    return df, shm
+
+
+def close(shm, unlink=False):
+    """
+    关闭共享内存。
+    如果还有对象引用着这块内存（比如arrow的字符串列在concat后仍然指向原来的buffer），不能马上解除映射，
+    这时把映射交给引用计数管理，最后一个引用释放时自动解除；unlink 照样生效，不影响已经映射的数据。
+    """
+    try:
+        shm.close()
+    except BufferError:
+        shm._buf = None
+        shm._mmap = None
+        shm.close()
+    if unlink:
+        # _attach 时取消了登记，unlink 内部会再取消一次，所以先登记回去
+        resource_tracker.register(shm._name, 'shared_memory')
+        shm.unlink()
+
+
+def get_df(name, size, unlink=False):
+    """从共享内存读取dataframe，拷贝一份返回，返回的dataframe不依赖这块共享内存"""
+    df, shm = open_df(name, size)
+    df = df.copy()
+    close(shm, unlink)
+    return df
+
+
+def remove(name):
+    """删除共享内存，已经不存在就忽略"""
+    try:
+        shm = _attach(name)
+    except FileNotFoundError:
+        return
+    close(shm, unlink=True)
+
+
+def run_task(args):
+    """
+    子进程中执行的函数：从共享内存零拷贝读取输入，计算，结果写到新的共享内存。
+    args = (func, (name, size), func_params)，func(df, *func_params) 返回dataframe
+    注意，传给func的df数值列是只读的，需要原地修改的话先 df.copy()
+    """
+    func, (name, size), func_params = args
+    df, shm = open_df(name, size)
+    result = func(df, *func_params)
+    result = put_df(result)
+    del df
+    close(shm)
+    return result